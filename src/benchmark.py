@@ -0,0 +1,231 @@
+"""
+Benchmark of the pipeline on synthetic sensors.
+
+For every scale (a multiple of the users) the synthetic sensors are written in <WORKDIR>/scale_<SCALE>/raw, every
+sensor is processed by src.feature and the features are joined by src.join_features. Every run is in a new process,
+its peak RSS is its own. The results have wall time, CPU time, peak RSS and rows per second of every run and of its
+stages (e.g., the aggregate stage of every sensor), with the commit of the code, and can be compared across commits.
+"""
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from src.feature import sensor_family
+from src.utils.profiling import StageReport
+from src.utils.synthetic import write_dataset
+from src.utils.utils import get_logger
+
+# a sensor of every family
+SENSORS = ['accelerometer', 'accelerometeruncalibrated', 'rotationvector', 'light', 'screen', 'activities',
+           'batterycharge', 'location', 'applications', 'bluetooth', 'wifinetworks', 'wifi', 'cellularnetwork',
+           'stepcounter', 'stepdetector', 'touch', 'notification', 'batterylevel']
+RUN_KEYS = ['scale', 'stage', 'sensor']
+
+
+def git_commit() -> dict:
+    """commit of the code and whether the working tree has changes, None if git is not available"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True,
+                                text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+    return {'commit': commit.strip(), 'dirty': len(status.strip()) > 0}
+
+
+def _file_logger(name: str, path: Path) -> logging.Logger:
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.FileHandler(path, mode='w'))
+    return logger
+
+
+def _measured(run: StageReport, stages: StageReport) -> dict:
+    """the single stage of run, with the totals of the stages recorded by the pipeline"""
+    record = {k: v for k, v in run.stages[0].items() if k not in ['name', 'start_s', 'depth']}
+    summary = stages.summary()
+    record['stages'] = json.loads(summary.to_json(orient='index')) if len(summary) > 0 else {}
+    return record
+
+
+def _run_feature(input_path: Path, timediary_path: Path, output_paths: List[Path], log_path: Path,
+                 window_sizes: List[int], timediary_include: bool, rows: int, workers: int,
+                 memory_budget_mb: int) -> dict:
+    import src.feature as feature
+    feature.logger = _file_logger('feature.py', log_path)
+    run = StageReport()
+    with run.stage('feature', rows=rows):
+        feature.main(input_path, timediary_path, output_paths, window_sizes, timediary_include,
+                     memory_budget_mb=memory_budget_mb, workers=workers)
+    return _measured(run, feature.report)
+
+
+def _run_join(paths: List[Path], output_path: Path, log_path: Path) -> dict:
+    import src.join_features as join_features
+    join_features.logger = _file_logger('join_features.py', log_path)
+    run = StageReport()
+    with run.stage('join') as record:
+        join_features.main(paths, output_path)
+        record['rows'] = sum(stage['rows'] for stage in join_features.report.stages if stage['name'] == 'join')
+    return _measured(run, join_features.report)
+
+
+def isolated(func, *args):
+    """result of func(*args) in a new process"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(func, *args).result()
+
+
+def run_scale(workdir: Path, scale: int, sensors: List[str], users: int, days: int, window_sizes: List[int],
+              timediary_include: bool, rate_scale: float = 1, rates: Dict[str, float] = None, seed: int = 0,
+              crep_timestamps: bool = False, workers: int = 1, memory_budget_mb: int = None) -> List[dict]:
+    """generate the sensors of users * scale users, process and join them, returns a record for every run"""
+    root = Path(workdir, f'scale_{scale}')
+    raw_dir, interim_dir, logs_dir = root / 'raw', root / 'interim', root / 'logs'
+    for directory in [interim_dir, logs_dir]:
+        directory.mkdir(parents=True, exist_ok=True)
+    logger.info(f'Generating {users * scale} users, {days} days, scale={scale}...')
+    rows = write_dataset(raw_dir, sensors, users * scale, days, rate_scale, rates, seed, crep_timestamps)
+
+    timediary_path = interim_dir / 'timediary.parquet'
+    if timediary_include:
+        import src.contribution as contribution
+        contribution.logger = logger
+        contribution.main(raw_dir / 'timediary.parquet', timediary_path)
+
+    base = {'scale': scale, 'users': users * scale, 'days': days}
+    records, features = [], []
+    for sensor_name in sensors:
+        output_paths = [interim_dir / f'{window_size}min' / f'{sensor_name}.parquet' for window_size in window_sizes]
+        logger.info(f'{sensor_name}: {rows[sensor_name]} rows')
+        record = isolated(_run_feature, raw_dir / f'{sensor_name}.parquet', timediary_path, output_paths,
+                          logs_dir / f'{sensor_name}.log', window_sizes, timediary_include, rows[sensor_name],
+                          workers, memory_budget_mb)
+        records.append({**base, 'stage': 'feature', 'sensor': sensor_name, 'family': sensor_family(sensor_name),
+                        **record})
+        logger.info(f'{sensor_name}: {record["wall_s"]:.2f} s, {record["rows_per_s"]:.0f} rows/s, '
+                    f'peak RSS {record["peak_rss_mb"]:.0f} MB')
+        if output_paths[0].exists():
+            features.append(output_paths[0])
+
+    record = isolated(_run_join, features, root / 'processed' / 'joined_features.parquet', logs_dir / 'join.log')
+    records.append({**base, 'stage': 'join', 'sensor': None, 'family': None, **record})
+    logger.info(f'join: {record["wall_s"]:.2f} s, peak RSS {record["peak_rss_mb"]:.0f} MB')
+    return records
+
+
+def environment() -> dict:
+    return {**git_commit(), 'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+            'pyarrow': pa.__version__, 'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+
+def runs_frame(results: dict) -> pd.DataFrame:
+    """a row for every run, with the wall time of every stage of the pipeline as <stage>_s"""
+    runs = pd.DataFrame(results['runs'])
+    stages = pd.DataFrame([{f'{name}_s': stage['wall_s'] for name, stage in (run or {}).items()}
+                           for run in runs.pop('stages')], index=runs.index)
+    return runs.join(stages)
+
+
+def scaling(results: dict, value: str = 'rows_per_s') -> pd.DataFrame:
+    """value of every run (e.g., rows per second or peak RSS), a column for every scale"""
+    runs = runs_frame(results)
+    runs['sensor'] = runs['sensor'].fillna(runs['stage'])
+    return runs.pivot(index='sensor', columns='scale', values=value)
+
+
+def compare(base: dict, new: dict) -> pd.DataFrame:
+    """runs of both results, with the ratio new / base of wall time, aggregate time and peak RSS.
+    A ratio larger than 1 is a slowdown"""
+    base_runs, new_runs = runs_frame(base), runs_frame(new)
+    columns = [c for c in ['wall_s', 'aggregate_s', 'peak_rss_mb', 'rows_per_s'] if c in base_runs.columns]
+    for runs in [base_runs, new_runs]:
+        runs['sensor'] = runs['sensor'].fillna('')
+        for c in columns:
+            if c not in runs.columns:
+                runs[c] = np.nan
+    comparison = base_runs[RUN_KEYS + columns].merge(new_runs[RUN_KEYS + columns], on=RUN_KEYS,
+                                                     suffixes=('_base', '_new'))
+    for c in ['wall_s', 'aggregate_s', 'peak_rss_mb']:
+        if c in columns:
+            comparison[f'{c}_ratio'] = comparison[f'{c}_new'] / comparison[f'{c}_base']
+    return comparison
+
+
+def main(output_path: Path, workdir: Path, sensors: List[str], users: int, days: int, scales: List[int],
+         window_sizes: List[int], timediary_include: bool, rate_scale: float = 1, rates: Dict[str, float] = None,
+         seed: int = 0, crep_timestamps: bool = False, workers: int = 1, memory_budget_mb: int = None) -> dict:
+    settings = {'sensors': sensors, 'users': users, 'days': days, 'scales': scales, 'window_sizes': window_sizes,
+                'timediary': timediary_include, 'rate_scale': rate_scale, 'rates': rates, 'seed': seed,
+                'crep_timestamps': crep_timestamps, 'workers': workers, 'memory_budget_mb': memory_budget_mb}
+    results = {**environment(), 'settings': settings, 'runs': []}
+    for scale in scales:
+        results['runs'] += run_scale(workdir, scale, sensors, users, days, window_sizes, timediary_include,
+                                     rate_scale, rates, seed, crep_timestamps, workers, memory_budget_mb)
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    logger.info(f'Results written in {output_path}')
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', default='logs/benchmark.json', help='path of the JSON results')
+    parser.add_argument('-l', '--logs', default='logs/benchmark.log', help='path to logging file')
+    parser.add_argument('--workdir', default='data/benchmark',
+                        help='directory of the synthetic sensors and of their features')
+    parser.add_argument('-s', '--sensors', nargs='+', default=SENSORS, help='sensors, by default one of every family')
+    parser.add_argument('-u', '--users', type=int, default=4, help='users at scale 1')
+    parser.add_argument('-d', '--days', type=int, default=7)
+    parser.add_argument('--scales', type=int, nargs='+', default=[1],
+                        help='multiples of the users, e.g., 1 2 4 for a scaling curve')
+    parser.add_argument('--rate-scale', type=float, default=1,
+                        help='multiplies the readings per hour of every sensor (src/utils/synthetic.py)')
+    parser.add_argument('--rates', nargs='+', default=[], metavar='SENSOR=RATE',
+                        help='readings per hour of every user of the given sensors, e.g., accelerometer=18000')
+    parser.add_argument('-f', '--window-size', type=int, nargs='+', default=[30])
+    parser.add_argument('-ti', '--timediary_include', type=str, choices=['True', 'False'], default='False')
+    parser.add_argument('--crep-timestamps', action='store_true',
+                        help='timestamps as strings in the CREP format instead of typed timestamps')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-w', '--workers', type=int, default=1)
+    parser.add_argument('-m', '--memory-budget', type=int, default=None)
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), default=None,
+                        help='compare two results instead of running the benchmark')
+    parser.add_argument('--threshold', type=float, default=None,
+                        help='with --compare, exit with an error if a run is slower by more than this fraction')
+    args = parser.parse_args()
+
+    pd.set_option('display.width', 200)
+    pd.set_option('display.max_columns', 20)
+    if args.compare is not None:
+        base, new = (json.load(open(path)) for path in args.compare)
+        comparison = compare(base, new)
+        print(f'base {base["commit"]}, new {new["commit"]}')
+        print(comparison.to_string(index=False, float_format='{:.3f}'.format))
+        if args.threshold is not None and (comparison['wall_s_ratio'] > 1 + args.threshold).any():
+            sys.exit(1)
+    else:
+        Path(args.logs).parent.mkdir(parents=True, exist_ok=True)
+        logger = get_logger(os.path.basename(__file__), args.logs)
+        results = main(Path(args.output), Path(args.workdir), args.sensors, args.users, args.days, args.scales,
+                       args.window_size, args.timediary_include == 'True', args.rate_scale,
+                       {s: float(r) for s, r in (rate.split('=') for rate in args.rates)}, args.seed,
+                       args.crep_timestamps, args.workers, args.memory_budget)
+        print(scaling(results).to_string(float_format='{:.0f}'.format))
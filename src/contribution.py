@@ -2,6 +2,9 @@ import os
 
 from pathlib import Path
 import pandas as pd
+from src.utils.interim import write_timediary
+from src.utils.timediary import build_index, index_path, write_index
+from src.utils.timestamps import decode_timestamps
 from src.utils.utils import get_logger
 
 
@@ -9,7 +12,7 @@ def main(input_path: Path, output_path: Path):
     logger.info('Loading users\' contributions...')
     df = pd.read_parquet(input_path)
     for col in ['timestamp']:
-        df[col] = pd.to_datetime(df[col], format='%m%d%H%M%S%f')
+        df[col] = decode_timestamps(df[col], local=False)
 
     # filter out timediary questions
     df = df[df['tag'] == 'time_diary']
@@ -21,7 +24,11 @@ def main(input_path: Path, output_path: Path):
         raise ValueError()
 
     assert (df.groupby(['userid', 'timestamp']).size() == 1).all()
-    df.to_csv(output_path, index=False)
+    write_timediary(df, output_path)
+    # windows of the answers read by every sensor, with local timestamps as read_timediary
+    tddf = pd.DataFrame({'userid': df['userid'], 'timestamp': df['timestamp'].dt.tz_localize(None)})
+    write_index(build_index(tddf), index_path(output_path))
+    logger.info(f'Window index of {tddf.userid.nunique()} users written in {index_path(output_path)}')
 
 
 if __name__ == '__main__':
@@ -31,7 +38,7 @@ if __name__ == '__main__':
     parser.add_argument('-i', '--input', help='timediary path',
                         default='/Users/munkhdelger/Knowdive/feature-engineering/data/raw/timediary.parquet')
     parser.add_argument('-o', '--output',
-                        default='/Users/munkhdelger/Knowdive/feature-engineering/data/interim/timediary.csv')
+                        default='/Users/munkhdelger/Knowdive/feature-engineering/data/interim/timediary.parquet')
     parser.add_argument('-l', '--logs', help='path to logging file',
                         default='/Users/munkhdelger/Knowdive/feature-engineering/logs/get_user_label.log')
     args = parser.parse_args()
@@ -1,69 +1,245 @@
-import glob
+import functools
 import logging
+import itertools
+import math
 import os
 import time
-import scipy
+import scipy.sparse
+from contextlib import nullcontext
 import numpy as np
 import pandas as pd
+import pyarrow.dataset as ds
 from pathlib import Path
-from src.utils.utils import _intervalindex_to_columns, get_logger, radius_of_gyration, get_total_distance_covered, \
-    centermost_point
-
-
-def compute_windows_intervals(contribution: pd.DataFrame, window_size_mins: int) -> pd.IntervalIndex:
+from typing import Callable, NamedTuple
+from src.config import sensors_config
+from src.utils.cache import load_normalized
+from src.utils.categories import load_app_categories, category_codes, category_column
+from src.utils.incremental import load_state, save_state, read_new_readings, select_new_readings, \
+    drop_closed_windows, upsert, update_state
+from src.utils.interim import write_features
+from src.utils.partial import moments, value_counts, finalize_moments, distinct, entropy, window_positions, merge
+from src.utils.parallel import run_shards, shard_users
+from src.utils.profiling import StageReport, profiled
+from src.utils.stream import iter_batches, iter_user_chunks, open_dataset, count_rows_per_user, estimate_row_size
+from src.utils.timediary import TimediaryIndex, diary_windows, load_index
+from src.utils.timestamps import decode_timestamps
+from src.utils.utils import _intervalindex_to_columns, get_logger, mobility_features
+
+
+# timing of the stages of the run, written next to the log
+report = StageReport()
+
+
+def compute_windows_intervals_single_sensor(contribution: pd.DataFrame, window_size_mins: int,
+                                            hop_mins: int = None, until: pd.Timestamp = None) -> pd.IntervalIndex:
     timestamp = 'timestamp'
-    start_interval = contribution[timestamp].dt.floor('s') - pd.Timedelta(minutes=int(window_size_mins / 2))
-    end_interval = contribution[timestamp].dt.floor('s') + pd.Timedelta(minutes=int(window_size_mins / 2))
-    intervals = pd.IntervalIndex.from_arrays(start_interval, end_interval, closed='left')
-    # if closed is change, remember to do the same in every place tha interval is used
-    assert not intervals.is_overlapping
-    return intervals
 
-
-def compute_windows_intervals_single_sensor(contribution: pd.DataFrame, window_size_mins: int) -> pd.IntervalIndex:
-    timestamp = 'timestamp'
+    if hop_mins is not None:
+        # sliding windows, a window starts every hop_mins, they overlap if hop_mins is smaller than the window.
+        # Windows are partial at both edges: the first ones start before the first reading and the last one starts
+        # at the last reading, the readings at the edges are not in fewer windows than the others
+        overlap = -(-window_size_mins // hop_mins) - 1
+        start = contribution[timestamp].min().floor(f'{hop_mins}min') - pd.Timedelta(minutes=overlap * hop_mins)
+        end = contribution[timestamp].max().floor(f'{hop_mins}min')
+        starts = pd.date_range(start, end, freq=f'{hop_mins}min')
+        return pd.IntervalIndex.from_arrays(starts, starts + pd.Timedelta(minutes=window_size_mins), closed='left')
 
     # Floor the timestamps to the nearest interval of window_size_mins
     start = contribution[timestamp].min().floor(f'{window_size_mins}min')
     end = contribution[timestamp].max().ceil(f'{window_size_mins}min')
+    if until is not None:
+        # the windows span the readings up to until, e.g., a reading on the break before until has a window
+        end = max(end, until.ceil(f'{window_size_mins}min'))
     intervals = pd.date_range(start, end, freq=f'{window_size_mins}min')
     interval_index = pd.IntervalIndex.from_breaks(intervals, closed='left')
 
     return interval_index
 
 
+def compute_windows(sensor: pd.DataFrame, tddf: TimediaryIndex, window_size_mins: int,
+                    hop_mins: int = None, until: pd.Timestamp = None) -> pd.DataFrame:
+    """compute the time windows of every user in the sensor.
+    Windows are centered on the time diary answers if the index of the time diary (tddf) is given, otherwise they
+    span the sensor readings, or up to until for a slice of the readings that ends at until.
+    With hop_mins the windows span the sensor readings and start every hop_mins (sliding windows).
+    Returns one row per window (userid, start_interval, end_interval), sorted by userid and start_interval"""
+    if tddf is not None and hop_mins is not None:
+        raise ValueError('Sliding windows are computed without the time diary')
+    if tddf is not None:
+        return diary_windows(tddf, sensor.userid.unique(), window_size_mins)
+
+    bounds = sensor.groupby('userid').timestamp.agg(['min', 'max'])
+    windows = []
+    for user in sensor.userid.unique():
+        readings = pd.DataFrame({'timestamp': bounds.loc[user, ['min', 'max']].astype('datetime64[ns]')})
+        intervals = compute_windows_intervals_single_sensor(readings, window_size_mins, hop_mins, until)
+        windows.append(pd.DataFrame({'userid': user, 'start_interval': intervals.left, 'end_interval': intervals.right}))
+
+    if len(windows) == 0:
+        return pd.DataFrame({'userid': pd.Series(dtype=sensor.userid.dtype),
+                             'start_interval': pd.Series(dtype='datetime64[ns]'),
+                             'end_interval': pd.Series(dtype='datetime64[ns]')})
+    windows = pd.concat(windows, ignore_index=True)
+    return windows.sort_values(['userid', 'start_interval'], ignore_index=True)
+
+
+def factorize_windows(windows: pd.DataFrame):
+    """code of every window and the distinct windows sorted by start and end, as an IntervalIndex.
+    Windows are factorized on their bounds instead of Interval objects"""
+    bounds = np.stack([windows['start_interval'].to_numpy(dtype='datetime64[ns]').view(np.int64),
+                       windows['end_interval'].to_numpy(dtype='datetime64[ns]').view(np.int64)], axis=1)
+    bounds, codes = np.unique(bounds.reshape(-1, 2), axis=0, return_inverse=True)
+    categories = pd.IntervalIndex.from_arrays(bounds[:, 0].view('datetime64[ns]'),
+                                              bounds[:, 1].view('datetime64[ns]'), closed='left')
+    return codes.reshape(-1), categories
+
+
+def assign_windows(sensor: pd.DataFrame, windows: pd.DataFrame) -> pd.DataFrame:
+    """assign every sensor reading to its window in a single sorted pass.
+    The readings are sorted by userid and timestamp, then the contiguous readings of each user are matched
+    against the user's window breaks with searchsorted. The window is stored in the categorical column 'interval',
+    readings outside every window have a missing interval. Returns the sorted sensor with a new RangeIndex"""
+    sensor = sensor.sort_values(['userid', 'timestamp'], kind='stable', ignore_index=True)
+    timestamps = sensor['timestamp'].to_numpy(dtype='datetime64[ns]')
+
+    window_codes, categories = factorize_windows(windows)
+    window_left = windows['start_interval'].to_numpy(dtype='datetime64[ns]')
+    window_right = windows['end_interval'].to_numpy(dtype='datetime64[ns]')
+    windows_per_user = windows.groupby('userid').indices
+
+    user_codes, users = pd.factorize(sensor['userid'])
+    user_breaks = np.flatnonzero(np.diff(user_codes)) + 1
+    user_starts = np.concatenate([[0], user_breaks])
+    user_ends = np.concatenate([user_breaks, [len(sensor)]])
+
+    codes = np.full(len(sensor), -1, dtype=np.int64)
+    for user, lo, hi in zip(users, user_starts, user_ends):
+        user_windows = windows_per_user.get(user)
+        if user_windows is None:
+            continue
+        ts = timestamps[lo:hi]
+        # windows are closed on the left, take the last window starting before (or at) the reading
+        pos = np.searchsorted(window_left[user_windows], ts, side='right') - 1
+        inside = pos >= 0
+        inside[inside] = ts[inside] < window_right[user_windows[pos[inside]]]
+        codes[lo:hi][inside] = window_codes[user_windows[pos[inside]]]
+
+    sensor['interval'] = pd.Categorical.from_codes(codes, categories=categories)
+    return sensor
+
+
+def windows_of(userid, timestamp, windows: pd.DataFrame):
+    """pairs (position, window code) of every (userid, timestamp) and every window containing it, the codes are
+    the ones of factorize_windows. Windows of a user can overlap (sliding windows) but must not contain each
+    other: sorted by start they are also sorted by end, the windows containing a timestamp are contiguous"""
+    userid, timestamp = np.asarray(userid), np.asarray(timestamp, dtype='datetime64[ns]')
+    window_codes, _ = factorize_windows(windows)
+    window_left = windows['start_interval'].to_numpy(dtype='datetime64[ns]')
+    window_right = windows['end_interval'].to_numpy(dtype='datetime64[ns]')
+    windows_per_user = windows.groupby('userid').indices
+
+    positions, codes = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for user, rows in pd.Series(userid).groupby(userid, sort=False).indices.items():
+        user_windows = windows_per_user.get(user)
+        if user_windows is None:
+            continue
+        ts = timestamp[rows]
+        # first window ending after the timestamp and first window starting after it
+        lo = np.searchsorted(window_right[user_windows], ts, side='right')
+        hi = np.searchsorted(window_left[user_windows], ts, side='right')
+        n = np.maximum(hi - lo, 0)
+        offset = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        positions.append(np.repeat(rows, n))
+        codes.append(window_codes[user_windows[np.repeat(lo, n) + offset]])
+    return np.concatenate(positions), np.concatenate(codes)
+
+
+def segment_starts(index: pd.MultiIndex):
+    """userid and start of the segment of every row of a table indexed by segments"""
+    segment = index.get_level_values('interval')
+    return index.get_level_values('userid'), segment.categories.left[segment.codes]
+
+
+def compute_segments(windows: list) -> pd.DataFrame:
+    """split the windows of several window sizes at every break (start or end of a window) of the user.
+    A segment is either inside or outside every window, segments that are not in any window are removed.
+    Returns one row per segment (userid, start_interval, end_interval), sorted by userid and start_interval"""
+    breaks = pd.concat([pd.DataFrame({'userid': w['userid'], 'timestamp': w[column]})
+                        for w in windows for column in ['start_interval', 'end_interval']], ignore_index=True)
+    breaks = breaks.drop_duplicates().sort_values(['userid', 'timestamp'], ignore_index=True)
+    userid, timestamp = breaks['userid'].to_numpy(), breaks['timestamp'].to_numpy(dtype='datetime64[ns]')
+    same_user = userid[1:] == userid[:-1]
+    segments = pd.DataFrame({'userid': userid[:-1][same_user],
+                             'start_interval': timestamp[:-1][same_user],
+                             'end_interval': timestamp[1:][same_user]})
+    covered = np.zeros(len(segments), dtype=bool)
+    for w in windows:
+        covered[windows_of(segments['userid'], segments['start_interval'], w)[0]] = True
+    return segments[covered].reset_index(drop=True)
+
+
+def to_windows(table, windows: pd.DataFrame):
+    """relabel the rows of a table indexed by segments (userid, experimentid, interval and possibly a value) to
+    the windows containing the segments. A row is repeated for every window containing its segment (sliding
+    windows), rows of segments outside the windows are removed.
+    The interval is the code of the window in factorize_windows, integer keys are merged faster than intervals"""
+    position, window = windows_of(*segment_starts(table.index), windows)
+    index = table.index.to_frame(index=False).iloc[position]
+    index['interval'] = window
+    table = table.iloc[position]
+    table.index = pd.MultiIndex.from_frame(index)
+    return table
+
+
+def with_intervals(features: pd.DataFrame, codes: np.ndarray, intervals: pd.IntervalIndex) -> pd.DataFrame:
+    """replace the interval level of the features with the intervals of the codes, as categorical"""
+    features.index = pd.MultiIndex.from_arrays([features.index.get_level_values('userid'),
+                                                features.index.get_level_values('experimentid'),
+                                                pd.Categorical.from_codes(codes, categories=intervals)],
+                                               names=['userid', 'experimentid', 'interval'])
+    return features
+
 
 # =======================================================================================
 # ================================= CONNECTIVITY ========================================
 # =======================================================================================
 
-# def _compute_entropy(x):
-#     return scipy.stats.entropy(x.value_counts(normalize=True, sort=False), base=10)
-def _compute_entropy(x):
-    counts = x.value_counts(normalize=True, sort=False)
-    counts = counts.astype(float)
-    return scipy.stats.entropy(counts, base=10)
+def bluetoothdevices_partial(groups):
+    return {'moments': moments(groups, ['rssi']), 'counts': {'address': value_counts(groups, 'address')}}
 
 
-def bluetoothdevices(groups, prefix=''):
-    addresses = groups['address'].nunique().rename('addr_nuinque')
+def bluetoothdevices_finalize(partial, prefix=''):
+    rssi = finalize_moments(partial['moments'])['rssi']
+    addresses = distinct(partial['counts']['address'], rssi.index).rename('addr_nuinque')
     # paper Smartphone bluetooth base social sensing
-    entropy = groups['address'].apply(_compute_entropy).rename('entropy_basic')
-    rssi = groups['rssi'].agg(['mean', 'min', 'max', 'std', 'var'])
-    out = pd.concat([addresses, rssi, entropy], axis=1, verify_integrity=True)
+    entropy_basic = entropy(partial['counts']['address'], rssi.index).rename('entropy_basic')
+    out = pd.concat([addresses, rssi[['mean', 'min', 'max', 'std', 'var']], entropy_basic], axis=1,
+                    verify_integrity=True)
     out = out.add_prefix(prefix)
     return out
 
 
-def cellularnetwork(groups):
-    n_devices = groups.cellid.agg(lambda x: len(np.unique(x))).rename('num_of_devices')
-    entropy = groups.cellid.apply(_compute_entropy).rename('entropy_basic')
-    phone_strength = groups.dbm.agg([np.mean, np.min, np.max, np.std])
-    out = pd.concat([phone_strength, entropy, n_devices], axis=1, verify_integrity=True) \
+def bluetoothdevices(groups, prefix=''):
+    return bluetoothdevices_finalize(bluetoothdevices_partial(groups), prefix)
+
+
+def cellularnetwork_partial(groups):
+    return {'moments': moments(groups, ['dbm']), 'counts': {'cellid': value_counts(groups, 'cellid')}}
+
+
+def cellularnetwork_finalize(partial):
+    phone_strength = finalize_moments(partial['moments'])['dbm'][['mean', 'min', 'max', 'std']]
+    n_devices = distinct(partial['counts']['cellid'], phone_strength.index).rename('num_of_devices')
+    entropy_basic = entropy(partial['counts']['cellid'], phone_strength.index).rename('entropy_basic')
+    out = pd.concat([phone_strength, entropy_basic, n_devices], axis=1, verify_integrity=True) \
         .add_prefix('cellular_lte_')
     return out
 
 
+def cellularnetwork(groups):
+    return cellularnetwork_finalize(cellularnetwork_partial(groups))
+
+
 def wifi(groups):
     ft = groups.agg(wifi_is_connected=('isconnected', max))
     ft['wifi_is_connected'].fillna(False, inplace=True)
@@ -73,15 +249,24 @@ def wifi(groups):
     return ft
 
 
-def wifinetworks(groups):
+def wifinetworks_partial(groups):
+    return {'moments': moments(groups, ['rssi']), 'counts': {'address': value_counts(groups, 'address')}}
+
+
+def wifinetworks_finalize(partial):
+    rssi = finalize_moments(partial['moments'])['rssi']
     # wifi_num_of_devices,
-    return groups.agg(
-        num_of_devices=('address', lambda x: len(np.unique(x))),
-        mean_rssi=('rssi', np.mean),
-        min_rssi=('rssi', np.min),
-        max_rssi=('rssi', np.max),
-        std_rssi=('rssi', np.std)
-    ).add_prefix('wifi_')
+    return pd.DataFrame({
+        'num_of_devices': distinct(partial['counts']['address'], rssi.index),
+        'mean_rssi': rssi['mean'],
+        'min_rssi': rssi['min'],
+        'max_rssi': rssi['max'],
+        'std_rssi': rssi['std']
+    }).add_prefix('wifi_')
+
+
+def wifinetworks(groups):
+    return wifinetworks_finalize(wifinetworks_partial(groups))
 
 
 # =======================================================================================
@@ -89,23 +274,28 @@ def wifinetworks(groups):
 # =======================================================================================
 
 
-def _count_steps(x):
-    y = x.sort_values('timestamp', ascending=True)
-    y['change'] = y.value.diff()
-    # set the value to zero if the counter is decreasing. Probably a reboot occurred
-    y.loc[y['change'] < 0, 'value'] = 0
-    # recompute difference between detections
-    y['change'] = y.value.diff()
-    # cancel negative variations between counter detections
-    y['change'] = y['change'].clip(lower=0)
-    sum_of_diff = y['change'].sum()
-    return sum_of_diff
-
-
 def stepcounter(groups):
-    """https://developer.android.com/guide/topics/sensors/sensors_motion#sensors-motion-stepcounter"""
-    return groups.apply(_count_steps).rename(
-        'steps_counter').to_frame()  # added .to_frame() to convert it from series to dataframe
+    """https://developer.android.com/guide/topics/sensors/sensors_motion#sensors-motion-stepcounter
+    Sum of the increments of the counter in every window. A reading lower than the previous one is a reboot, the
+    reading is set to zero, so the steps up to the first reading after the reboot are not counted"""
+    sensor = groups.obj
+    window_index = groups.size().index
+    group = groups.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    valid = np.flatnonzero(group >= 0)
+    # readings sorted by window and timestamp
+    order = valid[np.lexsort((sensor['timestamp'].to_numpy()[valid], group[valid]))]
+    group = group[order]
+    value = sensor['value'].to_numpy(dtype=float, na_value=np.nan)[order]
+
+    same_group = np.r_[False, group[1:] == group[:-1]]
+    change = np.r_[np.nan, np.diff(value)]
+    # set the value to zero if the counter is decreasing. Probably a reboot occurred
+    value = np.where(same_group & (change < 0), 0, value)
+    # recompute difference between detections, cancel negative variations between counter detections
+    change = np.clip(np.r_[np.nan, np.diff(value)], 0, None)
+    change = np.where(same_group & ~np.isnan(change), change, 0)
+    steps = np.bincount(group, weights=change, minlength=len(window_index))
+    return pd.DataFrame({'steps_counter': steps}, index=window_index)
 
 
 def stepdetector(groups):
@@ -120,28 +310,24 @@ def stepdetector(groups):
 
 
 def location_feature(groups):
-    def _get_centermost_point(x):
-        cluster = x[['latitude', 'longitude']].to_numpy()
-        if len(cluster) > 0:
-            point = centermost_point(cluster)
-        else:
-            # there shouldn't be empty groups, so this branch is not reachable
-            # keep it for safety reasons
-            raise ValueError(f'No gps coords u={x.userid} interval=[{x.interval}]')
-        return pd.Series(point, index=['latitude', 'longitude'])
-
-    df_centermost = groups.apply(_get_centermost_point)
-
     features = groups.agg({'longitude': [np.mean, np.min, np.max],
                            'latitude': [np.mean, np.min, np.max],
                            'altitude': [np.mean, np.min, np.max],
                            'speed': [np.mean, np.min, np.max, np.std]})
     features.columns = features.columns.map('_'.join)
 
-    rog = groups.apply(radius_of_gyration).rename('radius_of_gyration')
-    dist = groups.apply(get_total_distance_covered).rename('distance_sum')
-
-    return df_centermost.join([features, rog, dist], validate='one_to_one').add_prefix('location_')
+    # centermost point, radius of gyration and distance of all the windows at once, on readings sorted by window
+    # and timestamp
+    sensor = groups.obj
+    group = groups.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    valid = np.flatnonzero(group >= 0)
+    order = valid[np.lexsort((sensor['timestamp'].to_numpy()[valid], group[valid]))]
+    mobility = pd.DataFrame(mobility_features(group[order],
+                                              sensor['latitude'].to_numpy(dtype=float)[order],
+                                              sensor['longitude'].to_numpy(dtype=float)[order]),
+                            index=features.index)
+    return mobility[['latitude', 'longitude']].join([features, mobility[['radius_of_gyration', 'distance_sum']]],
+                                                    validate='one_to_one').add_prefix('location_')
 
 
 # =======================================================================================
@@ -154,48 +340,54 @@ def touch(groups):
 
 
 def notification(groups):
-    return groups.status.value_counts().unstack()
-
-
-# error_keys = set() #added
-def application(groups):
-    def _get_app_category(apps, category_db) -> pd.Series:
-        categories = set()
-        apps = apps.unique()
-        for a in apps[apps != None]:
-            try:  # added
-                categories.add(category_db.loc[a, 'category'])  # change: genre -> category
-            except KeyError as e:  # added
-                # error_keys.add(a) #added
-                # logger.warning(e)
-                categories.add('app_not-found')  # added
-
-        d = {k: 1 for k in categories}
-        d['category_nunique'] = len(categories)
-        s = pd.Series(data=d,
-                      index=['category_nunique'] + list(category_db['category'].unique()))
-        return s
-
-    category_db = pd.read_csv(Path('src', 'utils', 'appcategories.csv'))
-    category_db.drop_duplicates(inplace=True)
-    category_db.set_index('app_id', verify_integrity=True, inplace=True)
-    app_stats = groups['applicationname'].nunique().rename('nunique')
-    categories_stat = groups['applicationname'].apply(_get_app_category,
-                                                      category_db).unstack()
-    entropy = groups['applicationname'].agg(_compute_entropy).rename('entropy_basic')
-    out = pd.concat([categories_stat, app_stats, entropy], axis=1, verify_integrity=True).add_prefix('app_')
-    out.columns = [c.replace(' ', '_').lower() for c in out.columns]
-    out = out.fillna(0)
-    return out
-
-
-def batterymonitoringlog(groups):
-    """https://developer.android.com/training/monitoring-device-state/battery-monitoring#CurrentLevel"""
-
-    ft = groups \
-        .apply(lambda x: x.sort_values('timestamp', ascending=True)) \
-        .groupby(level=[0, 1, 2])[['timestamp', 'level', 'scale']] \
-        .agg({'timestamp': ['first', 'last'], 'level': ['first', 'last'], 'scale': ['mean']})
+    """number of notifications of every status, the statuses that a block of readings does not have are 0"""
+    counts = groups.status.value_counts().unstack(fill_value=0)
+    statuses = pd.Index(sorted(set(counts.columns) | set(NOTIFICATION_STATUSES)), name=counts.columns.name)
+    return counts.reindex(columns=statuses, fill_value=0)
+
+
+def application(groups, exclude=()):
+    """categories, number of distinct apps and categories, entropy of the apps of every window.
+    The (window, app) counts are mapped to categories in a sparse crosstab. The categories in exclude are counted
+    in category_nunique but are not computed"""
+    window_index = groups.size().index
+    counts = value_counts(groups, 'applicationname')
+    app_stats = distinct(counts, window_index)
+    entropy_basic = entropy(counts, window_index)
+
+    # windows x categories, an app belongs to a single category
+    _, _, categories = load_app_categories()
+    window = window_positions(counts, window_index)
+    category = category_codes(counts.index.get_level_values(-1))
+    used = scipy.sparse.csc_matrix((np.ones(len(window)), (window, category)),
+                                   shape=(len(window_index), len(categories))) > 0
+    category_nunique = np.asarray(used.sum(axis=1)).ravel()
+
+    columns_to_exclude = set(exclude)
+    out = {'app_category_nunique': category_nunique.astype(float)}
+    for i, category in enumerate(categories[:-1]):  # apps not found are only counted
+        column = category_column(category)
+        if column not in columns_to_exclude:
+            out[column] = used[:, i].toarray().ravel().astype(float)
+    out['app_nunique'] = app_stats.to_numpy()
+    out['app_entropy_basic'] = entropy_basic.to_numpy()
+    return pd.DataFrame(out, index=window_index)
+
+
+def batterymonitoringlog(groups, exclude=()):
+    """https://developer.android.com/training/monitoring-device-state/battery-monitoring#CurrentLevel
+    The first and last timestamps are not computed if they are in exclude, the levels are needed by the delta"""
+
+    sensor = groups.obj
+    userid, timestamp = sensor['userid'].to_numpy(), sensor['timestamp'].to_numpy()
+    if not np.all((userid[1:] > userid[:-1]) | ((userid[1:] == userid[:-1]) & (timestamp[1:] >= timestamp[:-1]))):
+        # first and last of every window are in timestamp order
+        sensor = sensor.sort_values(['userid', 'timestamp'], kind='stable')
+        groups = sensor.groupby(groups.keys, sort=True, observed=True)
+    aggregations = {'level': ['first', 'last'], 'scale': ['mean']}
+    if not {'battery_timestamp_first', 'battery_timestamp_last'} <= set(exclude):
+        aggregations = {'timestamp': ['first', 'last'], **aggregations}
+    ft = groups[list(aggregations)].agg(aggregations)
 
     ft.columns = ft.columns.map('_'.join)
     ft['level_last'] = ft['level_last'] * 100 / ft['scale_mean']
@@ -210,186 +402,352 @@ def batterymonitoringlog(groups):
 # =======================================================================================
 
 
-def value_feature(groups, column_name, prefix=''):
-    return groups[column_name].agg([np.mean, np.std, np.min, np.max]).add_prefix(prefix)
+def value_feature_partial(groups, column_name):
+    return {'moments': moments(groups, [column_name])}
 
 
-def xyz_feature(groups, prefix=''):
-    def _compute_stats(x):
-        return x \
-            .assign(magnitude=lambda row: np.linalg.norm(row[['x', 'y', 'z']], axis=1))[['x', 'y', 'z', 'magnitude']] \
-            .agg(['min', 'max', 'mean', 'std'])
+def value_feature_finalize(partial, column_name, prefix=''):
+    return finalize_moments(partial['moments'])[column_name][['mean', 'std', 'min', 'max']].add_prefix(prefix)
 
-    tmp = groups.apply(_compute_stats).unstack()
-    tmp.columns = tmp.columns.map('_'.join)
-    return tmp.add_prefix(prefix)
 
+def value_feature(groups, column_name, prefix=''):
+    return value_feature_finalize(value_feature_partial(groups, column_name), column_name, prefix)
 
-def xyz_unc_feature(groups, prefix=''):
-    def _compute_stats(x):
-        # Compute magnitude first
-        x = x.assign(magnitude=lambda row: np.linalg.norm(row[['x', 'y', 'z']], axis=1))
 
-        # Keep only relevant columns for aggregation
-        cols = ['x', 'y', 'z', 'xunc', 'yunc', 'zunc', 'magnitude']
-        return x[cols].agg(['min', 'max', 'mean', 'std'])
+def _xyz_partial(groups, columns: list) -> dict:
+    """moments of the columns for every window. The 'magnitude' column is the norm of the x, y, z vector,
+    it is computed once on the whole sensor and aggregated with the other columns"""
+    keys = groups.keys
+    sensor = groups.obj[keys + [c for c in columns if c != 'magnitude']].copy(deep=False)
+    sensor['magnitude'] = np.linalg.norm(sensor[['x', 'y', 'z']].to_numpy(dtype=float, na_value=np.nan), axis=1)
+    return {'moments': moments(sensor.groupby(keys, sort=True, observed=True), columns)}
+
 
-    tmp = groups.apply(_compute_stats).unstack()
+def xyz_feature_finalize(partial, prefix=''):
+    """min, max, mean and std of every column of the xyz partial aggregate"""
+    stats = finalize_moments(partial['moments'])
+    tmp = pd.concat({c: stats[c][['min', 'max', 'mean', 'std']] for c in stats.columns.unique(level=0)}, axis=1)
     tmp.columns = tmp.columns.map('_'.join)  # flatten multiindex
     return tmp.add_prefix(prefix)
 
 
-def xyz_accuracy_scalar_feature(groups, prefix=''):
-    def _compute_stats(x):
-        # Calculate the magnitude for x, y, z
-        x = x.assign(magnitude=lambda row: np.linalg.norm(row[['x', 'y', 'z']], axis=1))
+def xyz_feature_partial(groups):
+    return _xyz_partial(groups, ['x', 'y', 'z', 'magnitude'])
 
-        # Aggregate the statistics for x, y, z, magnitude, accuracy, and scalar
-        stats = x[['x', 'y', 'z', 'magnitude', 'accuracy', 'scalar']].agg(['min', 'max', 'mean', 'std'])
 
-        return stats
+def xyz_unc_feature_partial(groups):
+    return _xyz_partial(groups, ['x', 'y', 'z', 'xunc', 'yunc', 'zunc', 'magnitude'])
 
-    # Apply the feature computation function and unstack the result
-    tmp = groups.apply(_compute_stats).unstack()
 
-    # Flatten the multi-level columns and join them
-    tmp.columns = tmp.columns.map('_'.join)
+def xyz_accuracy_scalar_feature_partial(groups):
+    return _xyz_partial(groups, ['x', 'y', 'z', 'magnitude', 'accuracy', 'scalar'])
 
-    # Add the prefix to the columns
-    return tmp.add_prefix(prefix)
+
+def xyz_feature(groups, prefix=''):
+    return xyz_feature_finalize(xyz_feature_partial(groups), prefix)
+
+
+def xyz_unc_feature(groups, prefix=''):
+    return xyz_feature_finalize(xyz_unc_feature_partial(groups), prefix)
+
+
+def xyz_accuracy_scalar_feature(groups, prefix=''):
+    return xyz_feature_finalize(xyz_accuracy_scalar_feature_partial(groups), prefix)
 
 
 def on_change_feature(groups, sensor_df, sensor_name: str, column_name: str, states: list, prefix='',
                       unknown_state=None) -> pd.DataFrame:
     """compute features for on-change sensors, e.g., screen status.
-    The method counts the seconds each state is active"""
-
-    # get window size from interval index
-    # TODO rimettere quello che c'era prima
-    window_size = 30
-
-    timestamps = None
-    if len(states) > 2:
-        timestamps = pd.DatetimeIndex(data=sensor_df.timestamp)
-        timestamps = timestamps.sort_values()
-        assert timestamps.is_monotonic_increasing
-
-    duration_per_group = []
-    for (userid, experimentid, interval), gr in groups:
-        # compute how many seconds there are from on state change to another
-        gr.sort_values(by='timestamp', ascending=True, inplace=True)
-        gr['duration'] = gr.timestamp.diff(periods=1).shift(-1).dt.total_seconds()
-
-        # add elapsed time from the last sensor reading to the end of the window
-        assert np.isnan(gr.loc[gr.index[-1], 'duration'])
-        gr.loc[gr.index[-1], 'duration'] = (gr.iloc[-1].interval.right - gr.iloc[-1].timestamp).total_seconds()
-
-        total_duration = gr.groupby([column_name]).duration.sum()
-        total_duration['interval'] = interval
-        total_duration['userid'] = userid
-        total_duration['experimentid'] = experimentid
-
-        # states that are not observed in a window to zero
-        for state in states:
-            if state not in total_duration.index:
-                total_duration[state] = 0
-
-        # ==================
-        # count number of episodes (ON and then OFF)
-
-        if sensor_name == 'screen':
-            # it can happen that there are sequence of on and off, they are not always interspersed
-            # groupby when the status changes from row to row
-            grouped_sequences = gr \
-                .groupby([(gr.status != gr.status.shift()).cumsum(), gr.status])['duration'] \
-                .sum() \
-                .reset_index(level=0, drop=True) \
-                .reset_index()  # reset sequence idx and reset status idx
-            # find episodes
-            grouped_sequences['episode'] = ((grouped_sequences.status == 'SCREEN_ON') & (
-                    grouped_sequences.status.shift(-1) == 'SCREEN_OFF'))
-
-            stats = grouped_sequences[grouped_sequences['episode']] \
-                .groupby('status')['duration'] \
-                .agg(['size', 'mean', 'min', 'max', 'std'])
-
-            assert len(stats) <= 1
-            stats = stats.reset_index()
-            total_duration['episodes_count'] = stats.iloc[0]['size'] if len(stats) > 0 else 0
-            total_duration['mean_seconds_per_episode'] = stats.iloc[0]['mean'] if len(stats) > 0 else 0
-            total_duration['min_seconds_per_episode'] = stats.iloc[0]['min'] if len(stats) > 0 else 0
-            total_duration['max_seconds_per_episode'] = stats.iloc[0]['max'] if len(stats) > 0 else 0
-            total_duration['std_seconds_per_episode'] = stats.iloc[0]['std'] if len(stats) > 0 else 0
-            if pd.isna(total_duration['std_seconds_per_episode']):  # is NaN if only one episode
-                total_duration['std_seconds_per_episode'] = 0
-
-        # ==================
-        # add time from the beginning of the window to the first sensor reading
-        if len(states) == 2:
-            # given that there are only 2 possible states,
-            # get the opposite state with respect to the first sensor reading.
-            # This applies to sensors like screen status
-            # Warning: there are no guarantees that previous status was the opposite one.
-            # Sometimes there is a sequence of reading reporitng the same state.
-            previous_last_state = [s for s in states if s != gr.iloc[0][column_name]][0]
+    The method counts the seconds each state is active. All the windows are computed at once on the readings
+    sorted by window and timestamp.
+    sensor_df must be sorted by userid and timestamp with a RangeIndex, as returned by assign_windows"""
+
+    window_index = groups.size().index
+    intervals = pd.IntervalIndex(window_index.get_level_values('interval'))
+    window_left = intervals.left.to_numpy(dtype='datetime64[ns]')
+    window_right = intervals.right.to_numpy(dtype='datetime64[ns]')
+
+    # readings are sorted by user and timestamp, a stable sort by window keeps them sorted by timestamp
+    window = groups.ngroup().to_numpy()
+    position = np.flatnonzero(~np.isnan(window))
+    position = position[np.argsort(window[position], kind='stable')]
+    window = window[position].astype(np.int64)
+
+    all_timestamps = sensor_df['timestamp'].to_numpy(dtype='datetime64[ns]')
+    all_states = sensor_df[column_name].to_numpy()
+    timestamp = all_timestamps[position]
+    state = all_states[position]
+    first = np.concatenate([[True], window[1:] != window[:-1]])
+    last = np.concatenate([window[1:] != window[:-1], [True]])
+
+    # compute how many seconds there are from on state change to another
+    # and add elapsed time from the last sensor reading to the end of the window
+    next_timestamp = np.empty_like(timestamp)
+    next_timestamp[:-1] = timestamp[1:]
+    next_timestamp[last] = window_right[window[last]]
+    duration = (next_timestamp - timestamp) / np.timedelta64(1, 's')
+
+    # ==================
+    # add time from the beginning of the window to the first sensor reading
+    first_position = position[first]
+    lead_in = (timestamp[first] - window_left) / np.timedelta64(1, 's')
+    if len(states) == 2:
+        # given that there are only 2 possible states,
+        # get the opposite state with respect to the first sensor reading.
+        # This applies to sensors like screen status
+        # Warning: there are no guarantees that previous status was the opposite one.
+        # Sometimes there is a sequence of reading reporitng the same state.
+        previous_last_state = np.where(all_states[first_position] == states[0], states[1], states[0])
+    else:
+        # this branch is used by activitiespertime
+        # if multiple possible states, take the last sensor readings before
+        # the start of the current time window. Please note that I cannot take the last value in the previous group
+        # because there might be a gap between the windows. It depends on the window size around the contribution
+        # questions
+        previous_position = first_position - 1
+        users = sensor_df['userid'].to_numpy()
+        has_previous = previous_position >= 0
+        has_previous[has_previous] = users[previous_position[has_previous]] == users[first_position[has_previous]]
+        if sensor_name in ['userpresence', 'screen']:
+            # 30 minutes is the frequency of the questions, if the previous sensor reading is too far away,
+            # discard it. This sensors shouldn't have a long gap between to sensor readings
+            threshold = np.timedelta64(30, 'm')
         else:
-            # this branch is used by activitiespertime
-            # if multiple possible states, take the last sensor readings before
-            # the start of the current time window. Please note that I cannot take the last value in the previous group
-            # because there might be a gap between the windows. It depends on the window size around the contribution
-            # questions
-            previous_last_state = unknown_state
-            first_ts_index = timestamps.get_loc(gr.iloc[0].timestamp)
-            if first_ts_index - 1 >= 0:
-                nearest_previous_sensor_reading_timestamp = timestamps[first_ts_index - 1]
-                nearest_previous_sensor_reading = sensor_df.loc[
-                    sensor_df.timestamp == nearest_previous_sensor_reading_timestamp]
-                assert len(nearest_previous_sensor_reading) == 1
-                nearest_previous_sensor_reading = nearest_previous_sensor_reading.iloc[0]
-                if sensor_name in ['userpresence', 'screen']:
-                    # 30 minutes is the frequency of the questions, if the previous sensor reading is too far away,
-                    # discard it. This sensors shouldn't have a long gap between to sensor readings
-                    threshold = pd.Timedelta(minutes=window_size)
-                else:
-                    threshold = pd.Timedelta(weeks=1000)
-                if (gr.iloc[0].timestamp - nearest_previous_sensor_reading.timestamp) <= threshold:
-                    previous_last_state = nearest_previous_sensor_reading[column_name]
-
-            if previous_last_state is None and first_ts_index - 1 >= 0:
-                raise ValueError('There is an error, this line shouldn\'t be reached')
-
-        if previous_last_state is not None:
-            total_duration[previous_last_state] += (gr.iloc[0].timestamp - gr.iloc[0].interval.left).total_seconds()
-
-        # ==================
-
-        assert total_duration.notna().all()
-        duration_per_group.append(total_duration)
-
-    duration_per_group = pd.concat(duration_per_group, axis=1).T
-    duration_per_group = duration_per_group.set_index(['userid', 'experimentid', 'interval'], verify_integrity=True)
-    # states that are not observed in a window to zero
-    duration_per_group[states] = duration_per_group[states].fillna(0)
+            threshold = np.timedelta64(1000, 'W')
+        is_close = has_previous.copy()
+        is_close[has_previous] = (all_timestamps[first_position[has_previous]] -
+                                  all_timestamps[previous_position[has_previous]]) <= threshold
+        previous_last_state = np.full(len(first_position), unknown_state, dtype=object)
+        previous_last_state[is_close] = all_states[previous_position[is_close]]
+
+        if unknown_state is None and (has_previous & ~is_close).any():
+            raise ValueError('There is an error, this line shouldn\'t be reached')
+
+    # ==================
+    # sum the seconds of each state, the time before the first reading goes to the previous state
+    has_previous_state = pd.notna(previous_last_state)
+    durations = pd.DataFrame({
+        'window': np.concatenate([window, np.flatnonzero(has_previous_state)]),
+        'state': np.concatenate([state, previous_last_state[has_previous_state]]),
+        'duration': np.concatenate([duration, lead_in[has_previous_state]]),
+    })
+    duration_per_group = durations.groupby(['window', 'state']).duration.sum().unstack(fill_value=0)
+
+    # states observed in the first window come first, states that are not observed in a window are set to zero
+    first_states = sorted(s for s in pd.unique(state[window == 0]) if pd.notna(s))
+    columns = first_states + [s for s in states if s not in first_states]
+    duration_per_group = duration_per_group.reindex(index=range(len(window_index)), columns=columns, fill_value=0)
+
+    # ==================
+    # count number of episodes (ON and then OFF)
+
+    if sensor_name == 'screen':
+        # it can happen that there are sequence of on and off, they are not always interspersed
+        # sum the durations of the consecutive readings with the same status in a window.
+        # The first reading of a window has no previous status to compare with, it is not part of any sequence
+        new_sequence = np.concatenate([[False], first[:-1] | (state[1:] != state[:-1])])[~first]
+        sequence = np.cumsum(new_sequence) - 1
+        sequence_duration = np.bincount(sequence, weights=duration[~first], minlength=new_sequence.sum())
+        sequence_state = state[~first][new_sequence]
+        sequence_window = window[~first][new_sequence]
+
+        # find episodes
+        next_in_window = np.concatenate([sequence_window[1:] == sequence_window[:-1], [False]])
+        next_state = np.concatenate([sequence_state[1:], [None]])
+        episode = (sequence_state == 'SCREEN_ON') & next_in_window & (next_state == 'SCREEN_OFF')
+
+        stats = pd.Series(sequence_duration[episode]) \
+            .groupby(sequence_window[episode]) \
+            .agg(['size', 'mean', 'min', 'max', 'std']) \
+            .reindex(range(len(window_index)), fill_value=0) \
+            .fillna(0)  # std is NaN if only one episode
+        stats.columns = ['episodes_count', 'mean_seconds_per_episode', 'min_seconds_per_episode',
+                         'max_seconds_per_episode', 'std_seconds_per_episode']
+        duration_per_group = duration_per_group.join(stats)
+
+    # ==================
+
+    duration_per_group.index = window_index
+    assert duration_per_group.notna().all(axis=None)
 
     # assert that total duration is not longer than the window size
-    assert (duration_per_group[states].sum(axis=1) <= (window_size * 60) + 1e-4).all()
+    window_size = (window_right - window_left) / np.timedelta64(1, 's')
+    assert (duration_per_group[states].sum(axis=1) <= window_size + 1e-4).all()
 
     duration_per_group.columns.name = None
     return duration_per_group.add_prefix(prefix)
 
 
-def main(input_path: Path, input_timediary: Path, output_path: Path, window_size_mins: int, timediary_include: bool):
-    sensor_name = input_path.stem
-    sensor_name = sensor_name.replace('event', '')
-    logger.info(f"Start feature generation sensor={sensor_name}")
-    start = time.time()
-    logger.info('Loading dataset...')
-    sensor = pd.read_parquet(input_path)
-    logger.info(f'Full dataset length: {len(sensor)}')
+ON_CHANGE_SENSORS = {
+    'screen': dict(prefix='screen_'),
+    'activities': dict(prefix='activity_', column='label', unknown_state='Unknown'),
+    'batterycharge': dict(prefix='battery_', column='source', unknown_state='no_charging'),
+    'userpresence': dict(prefix='user_presence_'),
+    'airplanemode': dict(prefix='airplanemode_'),
+    'headsetplug': dict(prefix='headset_'),
+    'ringmode': dict(prefix='ringmode_'),
+    'music': dict(prefix='music_'),
+    'doze': dict(prefix='doze_'),
+}
+
+# statuses of the notifications, every block of readings has their counts
+NOTIFICATION_STATUSES = ['notification_posted', 'notification_removed']
+
+VALUE_SENSORS = {'proximity': 'proximity_',
+                 'light': 'light_',
+                 'pressure': 'pressure_',
+                 'ambienttemperature': 'ambienttemperature_',
+                 'relativehumidity': 'relative_humidity_', }
+
 
-    sensor['timestamp'] = pd.to_datetime(sensor['timestamp'], format='%m%d%H%M%S%f')
-    sensor['timestamp'] = sensor['timestamp'].dt.tz_localize(None)  # Removes the timezone
-    sensor['timestamp'] = sensor['timestamp'].astype('datetime64[ns]')
+def fill_missing_states(sensor: pd.DataFrame, sensor_name: str) -> pd.DataFrame:
+    if sensor_name == 'batterycharge':
+        sensor.source.replace(np.nan, 'no_charging', inplace=True)
+    return sensor
+
+
+def get_possible_states(values: pd.Series) -> list:
+    """states of an on-change sensor, in order of appearance"""
+    possible_states = values.unique().tolist()
+    return [str(s) for s in possible_states]
+
+
+def cellularnetwork_lte_partial(groups):
+    """partial aggregate of the lte readings"""
+    sensor = groups.obj
+    return cellularnetwork_partial(sensor.loc[sensor['type'] == 'lte'].groupby(groups.keys, sort=True,
+                                                                                observed=True))
+
+
+def cellularnetwork_lte(groups):
+    """features of the lte readings, the windows without lte readings are kept and their features are missing"""
+    features = cellularnetwork_finalize(cellularnetwork_lte_partial(groups))
+    if len(features) == 0:
+        # the empty index cannot be aligned on the windows, e.g., a chunk of users without lte readings
+        return pd.DataFrame(np.nan, index=groups.size().index, columns=features.columns)
+    return features.reindex(groups.size().index)
+
+
+# =======================================================================================
+# ================================= REGISTRY ========================================
+# =======================================================================================
+
+
+# columns read for every sensor, besides the columns of its features
+KEY_COLUMNS = ['experimentid', 'userid', 'timestamp']
+
+
+class SensorSpec(NamedTuple):
+    """how the features of a sensor are computed.
+    columns are the raw columns read besides KEY_COLUMNS, aggregate computes the features of the windows from their
+    groups (on-change sensors also take the sensor and its states), partial and finalize are the mergeable partial
+    aggregates used by the rollup (None if the sensor has none), state_column is the state of on-change sensors and
+    exclude are the features that are not returned, by default columns_to_exclude of the sensor in src/config.py"""
+    columns: list
+    aggregate: Callable
+    family: str
+    partial: Callable = None
+    finalize: Callable = None
+    state_column: str = None
+    exclude: tuple = None
+
+
+def _excluded(sensor_name: str) -> tuple:
+    return tuple(sensors_config.get(sensor_name, {}).get('columns_to_exclude', []))
+
+
+def _value_spec(sensor_name: str, prefix: str) -> SensorSpec:
+    return SensorSpec(['value'], functools.partial(value_feature, column_name='value', prefix=prefix), 'value',
+                      functools.partial(value_feature_partial, column_name='value'),
+                      functools.partial(value_feature_finalize, column_name='value', prefix=prefix))
+
+
+def _on_change_spec(sensor_name: str, prefix: str, column: str = 'status', unknown_state=None) -> SensorSpec:
+    return SensorSpec([column], functools.partial(on_change_feature, sensor_name=sensor_name, column_name=column,
+                                                  prefix=prefix, unknown_state=unknown_state),
+                      'on_change', state_column=column)
+
+
+def _bluetooth_spec(sensor_name: str) -> SensorSpec:
+    prefix = sensor_name + '_'
+    return SensorSpec(['address', 'rssi'], functools.partial(bluetoothdevices, prefix=prefix), 'bluetooth',
+                      bluetoothdevices_partial, functools.partial(bluetoothdevices_finalize, prefix=prefix))
+
+
+def _xyz_spec(sensor_name: str, columns: list, feature, partial) -> SensorSpec:
+    prefix = sensor_name + '_'
+    return SensorSpec(columns, functools.partial(feature, prefix=prefix), 'xyz', partial,
+                      functools.partial(xyz_feature_finalize, prefix=prefix))
+
+
+SENSORS = {
+    **{name: _value_spec(name, prefix) for name, prefix in VALUE_SENSORS.items()},
+    **{name: _on_change_spec(name, **options) for name, options in ON_CHANGE_SENSORS.items()},
+    'wifi': SensorSpec(['isconnected'], wifi, 'wifi'),
+    'wifinetworks': SensorSpec(['address', 'rssi'], wifinetworks, 'wifinetworks', wifinetworks_partial,
+                               wifinetworks_finalize),
+    'location': SensorSpec(['latitude', 'longitude', 'altitude', 'speed'], location_feature, 'location'),
+    'cellularnetwork': SensorSpec(['cellid', 'dbm', 'type'], cellularnetwork_lte, 'cellularnetwork',
+                                  cellularnetwork_lte_partial, cellularnetwork_finalize),
+    'stepdetector': SensorSpec([], stepdetector, 'stepdetector'),
+    'stepcounter': SensorSpec(['value'], stepcounter, 'stepcounter'),
+    'touch': SensorSpec([], touch, 'touch'),
+    'notification': SensorSpec(['status'], notification, 'notification'),
+    'applications': SensorSpec(['applicationname'],
+                               functools.partial(application, exclude=_excluded('application')), 'applications',
+                               exclude=_excluded('application')),
+    **{name: SensorSpec(['level', 'scale'], functools.partial(batterymonitoringlog, exclude=_excluded(name)), name)
+       for name in ['batterymonitoringlog', 'batterylevel']},
+    **{name: _bluetooth_spec(name) for name in ['bluetoothnormal', 'bluetoothlowenergy', 'bluetooth']},
+    **{name: _xyz_spec(name, ['x', 'y', 'z'], xyz_feature, xyz_feature_partial)
+       for name in ['gyroscope', 'magneticfield', 'accelerometer', 'gravity', 'orientation', 'linearacceleration']},
+    **{name: _xyz_spec(name, ['x', 'y', 'z', 'xunc', 'yunc', 'zunc'], xyz_unc_feature,
+                       xyz_unc_feature_partial)
+       for name in ['accelerometeruncalibrated', 'magneticfielduncalibrated', 'gyroscopeuncalibrated']},
+    **{name: _xyz_spec(name, ['x', 'y', 'z', 'accuracy', 'scalar'], xyz_accuracy_scalar_feature,
+                       xyz_accuracy_scalar_feature_partial)
+       for name in ['rotationvector', 'geomagneticrotationvector']},
+}
+
+
+def sensor_spec(sensor_name: str) -> SensorSpec:
+    if sensor_name not in SENSORS:
+        raise ValueError(f"No features defined for the sensor '{sensor_name}'!")
+    return SENSORS[sensor_name]
+
+
+def sensor_family(sensor_name: str) -> str:
+    """family of the features of the sensor, stages of the sensors of a family can be compared in the reports"""
+    return SENSORS[sensor_name].family if sensor_name in SENSORS else sensor_name
+
+
+def partial_aggregate(sensor_name: str):
+    """partial and finalize functions of the sensors whose features are finalized from mergeable partial
+    aggregates, None for the other sensors"""
+    spec = sensor_spec(sensor_name)
+    return (spec.partial, spec.finalize) if spec.partial is not None else None
+
+
+def read_columns(input_path: Path, sensor_name: str) -> list:
+    """columns of the raw sensor read to compute its features, the other columns are not read"""
+    names = open_dataset(input_path).schema.names
+    return [c for c in KEY_COLUMNS + sensor_spec(sensor_name).columns if c in names]
+
+
+def drop_excluded(features: pd.DataFrame, sensor_name: str) -> pd.DataFrame:
+    """features without the excluded ones that the aggregate computed anyway"""
+    exclude = sensor_spec(sensor_name).exclude
+    exclude = [c for c in (_excluded(sensor_name) if exclude is None else exclude) if c in features.columns]
+    return features.drop(columns=exclude) if len(exclude) > 0 else features
+
+
+# version of preprocess, change it when the normalization changes to invalidate the cached sensors
+NORMALIZATION_VERSION = 2
+
+
+def preprocess(sensor: pd.DataFrame, sensor_name: str) -> pd.DataFrame:
+    with report.stage('decode', rows=len(sensor)):
+        sensor['timestamp'] = decode_timestamps(sensor['timestamp'])  # local time, the timezone is removed
 
     logger.info(f'Timestamp format changed ')
     if 'day' in sensor.columns:
@@ -397,141 +755,413 @@ def main(input_path: Path, input_timediary: Path, output_path: Path, window_size
     if sensor.index.has_duplicates:
         logger.warning('Reset index of the sensor, there are duplicates')
         sensor = sensor.reset_index(drop=True)
-    if sensor_name == 'batterycharge':
-        sensor.source.replace(np.nan, 'no_charging', inplace=True)
+    return fill_missing_states(sensor, sensor_name)
+
+
+def compute_features(sensor: pd.DataFrame, sensor_name: str, tddf: TimediaryIndex, window_size_mins: int,
+                     possible_states: list = None, windows: pd.DataFrame = None,
+                     until: pd.Timestamp = None) -> pd.DataFrame:
+    """compute the features of every window of the preprocessed sensor.
+    possible_states are the states of on-change sensors, by default they are taken from the sensor.
+    windows are non-overlapping windows used instead of the windows of tddf and window_size_mins, e.g., a family
+    of sliding windows, the readings outside them are not reported. until is the end of a slice of the readings,
+    see compute_windows.
+    Returns None if no reading is in a window"""
+    report_outside = windows is None
+    with report.stage('windows', rows=len(sensor)):
+        if windows is None:
+            logger.info('Computing windows...')
+            windows = compute_windows(sensor, tddf, window_size_mins, until=until)
+        sensor = assign_windows(sensor, windows)
+    logger.info(f'Users: {sensor.userid.nunique()}, windows: {len(windows)}')
+
+    outside = sensor['interval'].isna()
+    if outside.any() and report_outside:
+        logger.warning(f'Some sensors reading are not included in any window ({outside.sum()} readings)')
+        users_with_windows = set(sensor.userid[~outside].unique())
+        for user in sensor.userid.unique():
+            if user not in users_with_windows:
+                logger.warning(f'Skip user={user}, no sensor data is in a interval!')
+
+    if outside.all():
+        return None
+
+    groupbycolumns = ['userid', 'experimentid', 'interval']
+    groups = sensor.groupby(groupbycolumns, sort=True, group_keys=True, observed=True)
+    spec = sensor_spec(sensor_name)
+    with report.stage('aggregate', rows=int((~outside).sum()), family=spec.family):
+        if spec.state_column is not None:
+            if possible_states is None:
+                possible_states = get_possible_states(sensor[spec.state_column])
+
+            if len(possible_states) < 2:
+                raise ValueError(f'on-change sensor "{sensor_name}" has only less than 2 states ')
+
+            sensor[spec.state_column] = sensor[spec.state_column].astype('string')
+            groups = sensor.groupby(groupbycolumns, sort=True, observed=True)
+            features = spec.aggregate(groups, sensor, states=possible_states)
+        else:
+            features = spec.aggregate(groups)
+
+    return drop_excluded(features, sensor_name)
+
+
+def compute_features_rollup(sensor: pd.DataFrame, sensor_name: str, tddf: TimediaryIndex, window_sizes: list,
+                            hop_mins: int = None, until: pd.Timestamp = None) -> dict:
+    """compute the features of several window sizes from the partial aggregates of the segments between the
+    breaks of all the windows, every window is the merge of its segments. The sensor is grouped only once.
+    With sliding windows the segments are the hops, every reading is aggregated once and every window merges the
+    partial aggregates of its hops.
+    Returns {window size: features}, features are None if no reading is in a window"""
+    partial_function, finalize = partial_aggregate(sensor_name)
+    keys = ['userid', 'experimentid', 'interval']
+    logger.info('Computing windows...')
+    with report.stage('windows', rows=len(sensor)):
+        windows = {window_size: compute_windows(sensor, tddf, window_size, hop_mins, until)
+                   for window_size in window_sizes}
+        segments = compute_segments(list(windows.values()))
+        sensor = assign_windows(sensor, segments)
+    logger.info(f'Users: {sensor.userid.nunique()}, segments: {len(segments)}')
+
+    with report.stage('aggregate', rows=len(sensor), family=sensor_family(sensor_name)):
+        groups = sensor.groupby(keys, sort=True, observed=True)
+        partial = partial_function(groups)
+        size = groups.size()
+
+    features = {}
+    for window_size, w in windows.items():
+        _, intervals = factorize_windows(w)
+        readings = to_windows(size, w).groupby(level=keys, sort=True, observed=True).sum()
+        # readings of the segments in a window, counted once also if the windows overlap
+        inside = size.iloc[np.unique(windows_of(*segment_starts(size.index), w)[0])].sum()
+        logger.info(f'window_size={window_size} windows: {len(w)}, readings in a window: {inside}')
+        if inside < len(sensor):
+            logger.warning(f'Some sensors reading are not included in any window of {window_size} minutes '
+                           f'({len(sensor) - inside} readings)')
+        if len(readings) == 0:
+            features[window_size] = None
+            continue
+        with report.stage('rollup', rows=len(size), family=sensor_family(sensor_name), window_size=window_size):
+            relabelled = {'moments': to_windows(partial['moments'], w)} if 'moments' in partial else {}
+            if 'counts' in partial:
+                relabelled['counts'] = {c: to_windows(counts, w) for c, counts in partial['counts'].items()}
+            # windows without readings of the partial aggregate (e.g., without lte readings) have missing features
+            ft = drop_excluded(finalize(merge([relabelled], keys)).reindex(readings.index), sensor_name)
+        features[window_size] = with_intervals(ft, ft.index.get_level_values('interval'), intervals)
+    return features
+
+
+def compute_features_sliding(sensor: pd.DataFrame, sensor_name: str, window_size_mins: int, hop_mins: int,
+                             possible_states: list = None) -> pd.DataFrame:
+    """compute the features of sliding windows of sensors without mergeable partial aggregates.
+    The windows of a user are split in families of non-overlapping windows (every ceil(window / hop) windows),
+    the features of every family are computed as usual, a reading is processed once for every family.
+    Returns None if no reading is in a window"""
+    sensor = sensor.sort_values(['userid', 'timestamp'], kind='stable', ignore_index=True)
+    state_column = sensor_spec(sensor_name).state_column
+    if possible_states is None and state_column is not None:
+        # the same states in the same order for every family
+        possible_states = get_possible_states(sensor[state_column])
+    windows = compute_windows(sensor, None, window_size_mins, hop_mins)
+    codes, intervals = factorize_windows(windows)
+    families = -(-window_size_mins // hop_mins)
+    family = windows.groupby('userid').cumcount().to_numpy() % families
+    logger.info(f'Sliding windows: {len(windows)}, families of non-overlapping windows: {families}')
+
+    features = []
+    for i in range(families):
+        rows = np.flatnonzero(family == i)
+        ft = compute_features(sensor, sensor_name, None, window_size_mins, possible_states, windows.iloc[rows])
+        if ft is None:
+            continue
+        # codes of the windows of the family in the windows of all the families
+        family_codes, _ = factorize_windows(windows.iloc[rows])
+        to_codes = np.empty(len(rows), dtype=np.int64)
+        to_codes[family_codes] = codes[rows]
+        features.append(with_intervals(ft, to_codes[ft.index.get_level_values('interval').codes], intervals))
+    if len(features) == 0:
+        logger.warning('None of the sensor readings is in a window')
+        return None
+    return concat_features(features).sort_index()
+
+
+def compute_resolutions(sensor: pd.DataFrame, sensor_name: str, tddf: TimediaryIndex, window_sizes: list,
+                        possible_states: list = None, hop_mins: int = None, until: pd.Timestamp = None) -> dict:
+    """compute the features of every window size on the same preprocessed sensor.
+    Sensors with mergeable partial aggregates are rolled up from the segments of the windows, the other sensors
+    are sorted once and computed for every window size. With hop_mins the windows are sliding windows.
+    until is the end of a slice of the readings of the users, see compute_windows.
+    Returns {window size: features}, features are None if no reading is in a window"""
+    report.add_users(sensor.groupby('userid').size().rename('rows').reset_index())
+    if (len(window_sizes) > 1 or hop_mins is not None) and partial_aggregate(sensor_name) is not None:
+        return compute_features_rollup(sensor, sensor_name, tddf, window_sizes, hop_mins, until)
+    if hop_mins is not None:
+        return {window_size: compute_features_sliding(sensor, sensor_name, window_size, hop_mins, possible_states)
+                for window_size in window_sizes}
+    if len(window_sizes) > 1:
+        # the readings of every window size are assigned on the sorted sensor
+        sensor = sensor.sort_values(['userid', 'timestamp'], kind='stable', ignore_index=True)
+    return {window_size: compute_features(sensor, sensor_name, tddf, window_size, possible_states, until=until)
+            for window_size in window_sizes}
+
+
+def concat_features(blocks: list) -> pd.DataFrame:
+    """concatenate the features of blocks of users. The intervals of the blocks are recoded on the windows of all
+    the blocks, pandas cannot combine categorical intervals that overlap (sliding windows)"""
+    intervals = [block.index.get_level_values('interval') for block in blocks]
+    codes, categories = factorize_windows(pd.DataFrame({
+        'start_interval': np.concatenate([i.categories.left.to_numpy(dtype='datetime64[ns]') for i in intervals]),
+        'end_interval': np.concatenate([i.categories.right.to_numpy(dtype='datetime64[ns]') for i in intervals])}))
+    offsets = np.cumsum([0] + [len(i.categories) for i in intervals])
+    return pd.concat([with_intervals(block, codes[offset:][i.codes], categories)
+                      for block, i, offset in zip(blocks, intervals, offsets)], axis=0)
+
+
+def concat_resolutions(blocks: list, window_sizes: list) -> dict:
+    """concatenate the features of every window size of blocks of users, None if no block has features"""
+    features = {}
+    for window_size in window_sizes:
+        ft = [block[window_size] for block in blocks if block[window_size] is not None]
+        features[window_size] = concat_features(ft) if len(ft) > 0 else None
+    return features
+
+
+def collect_possible_states(input_path: Path, sensor_name: str) -> list:
+    """states of on-change sensors, reading only the state column. None for the other sensors"""
+    column_name = sensor_spec(sensor_name).state_column
+    if column_name is None:
+        return None
+    values = [fill_missing_states(batch, sensor_name)[column_name].drop_duplicates()
+              for batch in iter_batches(input_path, columns=[column_name])]
+    return get_possible_states(pd.concat(values))
+
+
+def outside_windows(user, times: np.ndarray, tddf: TimediaryIndex, window_sizes: list) -> np.ndarray:
+    """mask of the times (multiples of every window size) that are not inside a window of the user, a window
+    starting at the time is not inside. Windows spanning the readings break at the multiples of their size"""
+    outside = np.ones(len(times), dtype=bool)
+    if tddf is None:
+        return outside
+    times = times.astype('datetime64[ns]')
+    for window_size in window_sizes:
+        windows = diary_windows(tddf, np.array([user]), window_size)
+        start = windows['start_interval'].to_numpy(dtype='datetime64[ns]')
+        end = windows['end_interval'].to_numpy(dtype='datetime64[ns]')
+        # windows of a user do not overlap, only the last window starting before the time can contain it
+        position = np.searchsorted(start, times, side='right') - 1
+        inside = (position >= 0) & (times > start[np.maximum(position, 0)]) & (times < end[np.maximum(position, 0)])
+        outside &= ~inside
+    return outside
+
+
+def last_readings(sensor: pd.DataFrame) -> pd.DataFrame:
+    """last reading of every userid, experimentid"""
+    return sensor.sort_values('timestamp', kind='stable').groupby(['userid', 'experimentid'], observed=True).tail(1)
+
+
+def windows_from(features: pd.DataFrame, start: pd.Timestamp) -> pd.DataFrame:
+    """features of the windows starting at start or later, None if there are none"""
+    if features is None:
+        return None
+    interval = features.index.get_level_values('interval')
+    left = interval.categories.left.to_numpy(dtype='datetime64[ns]')[interval.codes]
+    features = features[left >= start.to_datetime64()]
+    return features if len(features) > 0 else None
+
+
+def compute_features_streaming(input_path: Path, sensor_name: str, tddf: TimediaryIndex, window_sizes: list,
+                               memory_budget_mb: int, hop_mins: int = None) -> dict:
+    """compute the features reading the sensor in chunks of whole users that fit in the memory budget.
+    Features are computed per user, the states of on-change sensors are collected in a first pass on the state
+    column. A user larger than the budget is split in slices of time cut between windows (at multiples of every
+    window size), as an incremental run the last readings of a slice are added to the next slice and the windows
+    before the slice are dropped. Sliding windows always overlap, users are not split.
+    Returns {window size: features}"""
+    possible_states = collect_possible_states(input_path, sensor_name)
+
+    split_mins = functools.reduce(math.lcm, window_sizes) if hop_mins is None else None
+    chunks = iter_user_chunks(input_path, memory_budget_mb, read_columns(input_path, sensor_name), split_mins,
+                              functools.partial(outside_windows, tddf=tddf, window_sizes=window_sizes))
+    features, previous = [], None
+    for i in itertools.count():
+        with report.stage('load', chunk=i) as record:
+            chunk = next(chunks, None)
+            record['rows'] = len(chunk.readings) if chunk is not None else 0
+        if chunk is None:
+            break
+        sensor = chunk.readings
+        logger.info(f'chunk={i} users={sensor.userid.nunique()} length={len(sensor)}' +
+                    (f' from={chunk.start}' if chunk.start is not None else '') +
+                    (f' to={chunk.end}' if chunk.end is not None else ''))
+        sensor = preprocess(sensor, sensor_name)
+        if chunk.start is not None:
+            # the last readings of the previous slice are the previous state of the readings of the slice
+            sensor = pd.concat([previous, sensor], ignore_index=True)
+        previous = last_readings(sensor) if chunk.end is not None else None
+        # the windows of a slice span the slice up to its end
+        block = compute_resolutions(sensor, sensor_name, tddf, window_sizes, possible_states, hop_mins, chunk.end)
+        if chunk.start is not None:
+            block = {window_size: windows_from(ft, chunk.start) for window_size, ft in block.items()}
+        features.append(block)
+        del sensor
+    return concat_resolutions(features, window_sizes)
+
+
+def _init_worker(logger_name: str):
+    global logger
+    logger = logging.getLogger(logger_name)
+
+
+def _compute_features_users(users: list, input_path: Path, sensor_name: str, tddf: TimediaryIndex,
+                            window_sizes: list, possible_states: list, hop_mins: int = None) -> dict:
+    """features of every window size of the given users, run by a worker"""
+    sensor = open_dataset(input_path).to_table(columns=read_columns(input_path, sensor_name),
+                                               filter=ds.field('userid').isin(users)).to_pandas()
+    logger.info(f'users={users} length={len(sensor)}')
+    sensor = preprocess(sensor, sensor_name)
+    return compute_resolutions(sensor, sensor_name, tddf, window_sizes, possible_states, hop_mins)
+
+
+def compute_features_parallel(input_path: Path, sensor_name: str, tddf: TimediaryIndex, window_sizes: list,
+                              workers: int, memory_budget_mb: int = None, hop_mins: int = None) -> dict:
+    """compute the features of shards of users on a pool of workers.
+    Every worker reads only the readings of its shard, with a memory budget a shard fits in the budget divided
+    by the workers. Blocks are concatenated in the order of the users, the result does not depend on the workers.
+    The users of a failed shard are skipped. Returns {window size: features}"""
+    possible_states = collect_possible_states(input_path, sensor_name)
+
+    dataset = open_dataset(input_path)
+    rows_per_user = count_rows_per_user(dataset)
+    max_rows = None
+    if memory_budget_mb is not None:
+        max_rows = max(int(memory_budget_mb / workers * 2 ** 20 /
+                           estimate_row_size(dataset, read_columns(input_path, sensor_name))), 1)
+    shards = shard_users(rows_per_user, workers, max_rows)
+    logger.info(f'Users: {len(rows_per_user)}, shards: {len(shards)}, workers: {workers}')
+    report.add_users(rows_per_user.rename('rows').rename_axis('userid').reset_index())
+
+    # the stages of the workers are not reported, the CPU time includes the workers
+    with report.stage('shards', rows=int(rows_per_user.sum()), family=sensor_family(sensor_name),
+                      shards=len(shards), workers=workers):
+        blocks = run_shards(_compute_features_users, shards, workers, logger,
+                            args=(input_path, sensor_name, tddf, window_sizes, possible_states, hop_mins),
+                            initializer=_init_worker, initargs=(logger.name,))
+    return concat_resolutions([blocks[i] for i in sorted(blocks)], window_sizes)
+
+
+def compute_features_incremental(input_path: Path, sensor_name: str, tddf: TimediaryIndex, window_size_mins: int,
+                                 state_dir: Path) -> pd.DataFrame:
+    """compute the features of the readings after the watermarks and upsert them in the features computed so far.
+    The state is kept in state_dir, see src.utils.incremental"""
+    state, possible_states, computed = load_state(state_dir)
+    logger.info(f'Incremental run, watermarks: {len(state)}')
+    sensor = preprocess(read_new_readings(input_path, state, read_columns(input_path, sensor_name)), sensor_name)
+    sensor = select_new_readings(sensor, state)
+    logger.info(f'New readings: {len(sensor)}')
+
+    prefix = None
+    column_name = sensor_spec(sensor_name).state_column
+    if column_name is not None:
+        prefix = ON_CHANGE_SENSORS[sensor_name]['prefix']
+        possible_states = possible_states or []
+        possible_states += [s for s in get_possible_states(sensor[column_name]) if s not in possible_states]
+
+    features = compute_features(sensor, sensor_name, tddf, window_size_mins, possible_states) \
+        if len(sensor) > 0 else None
+    if features is not None:
+        features = features.reset_index(names=['userid', 'experimentid', 'interval'])
+        _intervalindex_to_columns(features)
+        features = upsert(computed, drop_closed_windows(features, state), state)
+        if prefix is not None:
+            # states observed only in the new readings are zero in the previous windows
+            columns = [prefix + s for s in possible_states]
+            features[columns] = features[columns].fillna(0)
+    else:
+        features = computed
+
+    if len(sensor) > 0:
+        state = update_state(sensor, compute_windows(sensor, tddf, window_size_mins), state)
+    if features is not None:
+        save_state(state_dir, state, possible_states, features)
+    logger.info(f'Watermarks: {len(state)}')
+    return features
+
+
+def main(input_path: Path, input_timediary: Path, output_path, window_size_mins, timediary_include: bool,
+         memory_budget_mb: int = None, incremental: Path = None, workers: int = 1, cache_dir: Path = None,
+         cache_size_mb: int = None, hop_mins: int = None):
+    """window_size_mins and output_path are a single window size and path, or lists with a path for every
+    window size. The sensor is read once for all the window sizes.
+    With hop_mins a window starts every hop_mins minutes, windows overlap if hop_mins is smaller than their size"""
+    window_sizes = window_size_mins if isinstance(window_size_mins, list) else [window_size_mins]
+    output_paths = output_path if isinstance(output_path, list) else [output_path]
+    if len(window_sizes) != len(output_paths):
+        raise ValueError(f'{len(window_sizes)} window sizes and {len(output_paths)} output paths')
+    if incremental is not None and len(window_sizes) > 1:
+        raise ValueError('Incremental runs support a single window size')
+    if hop_mins is not None:
+        if incremental is not None or timediary_include:
+            raise ValueError('Sliding windows are computed without the time diary and without incremental runs')
+        if hop_mins <= 0 or any(window_size < hop_mins for window_size in window_sizes):
+            raise ValueError(f'The hop ({hop_mins} minutes) must be positive and at most the window size')
+    sensor_name = input_path.stem
+    sensor_name = sensor_name.replace('event', '')
+    logger.info(f"Start feature generation sensor={sensor_name}")
+    start = time.time()
+    report.clear()
 
     # Check timediary
     if timediary_include:
         logger.info('Loading time diary...')
-        tddf = pd.read_csv(input_timediary,
-                           parse_dates=['timestamp', 'notificationtimestamp', 'answertimestamp'])
-        tddf['timestamp'] = tddf['timestamp'].dt.tz_localize(None)  # Removes the timezone
+        with report.stage('load_timediary') as record:
+            tddf = load_index(input_timediary)
+            record['rows'] = len(tddf.timestamps)
     else:
         logger.warning('Time diary is missing or empty. Will compute intervals from sensor data.')
         tddf = None
 
-    user_ids = sensor.userid.unique().tolist()
-    features = []
-    for user in user_ids:
-        logger.info(f'user={user}')
-        sensor_user = sensor[sensor.userid == user].copy()
-        if timediary_include:
-            td_user = tddf[tddf.userid == user]
-            intervals = compute_windows_intervals(td_user, window_size_mins)
-        else:
-            intervals = compute_windows_intervals_single_sensor(sensor_user, window_size_mins)
-        sensor_user['interval'] = pd.cut(sensor_user.timestamp, intervals, duplicates='raise')
-
-        if sensor_user['interval'].isna().any():
-            logger.warning(f'Some sensors reading are not included in any window')
-
-        if sensor_user['interval'].isna().all():
-            logger.warning(f'Skip user={user}, no sensor data is in a interval!')
+    if incremental is not None:
+        features = {window_sizes[0]: compute_features_incremental(input_path, sensor_name, tddf, window_sizes[0],
+                                                                  incremental)}
+    elif workers > 1:
+        logger.info(f'Computing features of shards of users on {workers} workers...')
+        features = compute_features_parallel(input_path, sensor_name, tddf, window_sizes, workers,
+                                             memory_budget_mb, hop_mins)
+    elif memory_budget_mb is None and cache_dir is not None:
+        logger.info('Loading normalized dataset...')
+        with report.stage('load', cache=True) as record:
+            sensor = load_normalized(input_path, sensor_name, lambda raw: preprocess(raw, sensor_name), cache_dir,
+                                     NORMALIZATION_VERSION, logger, cache_size_mb,
+                                     read_columns(input_path, sensor_name))
+            record['rows'] = len(sensor)
+        logger.info(f'Full dataset length: {len(sensor)}')
+        features = compute_resolutions(sensor, sensor_name, tddf, window_sizes, hop_mins=hop_mins)
+    elif memory_budget_mb is None:
+        logger.info('Loading dataset...')
+        with report.stage('load') as record:
+            sensor = pd.read_parquet(input_path, columns=read_columns(input_path, sensor_name))
+            record['rows'] = len(sensor)
+        logger.info(f'Full dataset length: {len(sensor)}')
+        sensor = preprocess(sensor, sensor_name)
+        features = compute_resolutions(sensor, sensor_name, tddf, window_sizes, hop_mins=hop_mins)
+    else:
+        logger.info(f'Loading dataset in chunks of users, memory budget {memory_budget_mb} MB...')
+        features = compute_features_streaming(input_path, sensor_name, tddf, window_sizes, memory_budget_mb,
+                                              hop_mins)
+
+    for window_size, path in zip(window_sizes, output_paths):
+        ft = features[window_size]
+        if ft is None:
+            # raise ValueError('None of the users has features, investigate the reason')
+            logger.info(f'None of the users has features, window_size={window_size}')
+            logger.info('feature engineering skipped')
             continue
 
-        on_change_sensors = {
-            'screen': dict(prefix='screen_'),
-            'activities': dict(prefix='activity_', column='label', unknown_state='Unknown'),
-            'batterycharge': dict(prefix='battery_', column='source', unknown_state='no_charging'),
-            'userpresence': dict(prefix='user_presence_'),
-            'airplanemode': dict(prefix='airplanemode_'),
-            'headsetplug': dict(prefix='headset_'),
-            'ringmode': dict(prefix='ringmode_'),
-            'music': dict(prefix='music_'),
-            'doze': dict(prefix='doze_'),
-        }
-
-        value_sensors = {'proximity': 'proximity_',
-                         'light': 'light_',
-                         'pressure': 'pressure_',
-                         'ambienttemperature': 'ambienttemperature_',
-                         'relativehumidity': 'relative_humidity_', }
-
-        groupbycolumns = ['userid', 'experimentid', 'interval']
-        sensor_user['interval'] = sensor_user['interval'].cat.remove_unused_categories()
-        groups = sensor_user.groupby(groupbycolumns, sort=True, group_keys=True)
-
-        if sensor_name in value_sensors.keys():
-            ft = value_feature(groups, 'value', value_sensors[sensor_name])
-        elif sensor_name == 'wifi':
-            ft = wifi(groups)
-        elif sensor_name == 'wifinetworks':
-            ft = wifinetworks(groups)
-        elif sensor_name in ['location']:
-            ft = location_feature(groups)
-        elif sensor_name == 'cellularnetwork':
-            groups = sensor_user.loc[sensor_user['type'] == 'lte'].groupby(groupbycolumns, sort=True, group_keys=True)
-            ft = cellularnetwork(groups)
-        elif sensor_name == 'stepdetector':
-            ft = stepdetector(groups)
-        elif sensor_name == 'stepcounter':
-            ft = stepcounter(groups)
-        elif sensor_name == 'touch':
-            ft = touch(groups)
-        elif sensor_name == 'notification':
-            ft = notification(groups)
-        elif sensor_name == 'applications':
-            ft = application(groups)
-        elif sensor_name in ['batterymonitoringlog', 'batterylevel']:
-            ft = batterymonitoringlog(groups)
-        elif sensor_name in ['bluetoothnormal', 'bluetoothlowenergy',
-                             'bluetooth']:  # added bluetooth
-            ft = bluetoothdevices(groups, prefix=sensor_name + '_')
-        elif sensor_name in ['gyroscope', 'magneticfield', 'accelerometer', 'gravity', 'orientation',
-                             'linearacceleration']:
-            ft = xyz_feature(groups, prefix=sensor_name + '_')
-        elif sensor_name in ['accelerometeruncalibrated', 'magneticfielduncalibrated', 'gyroscopeuncalibrated']:
-            ft = xyz_unc_feature(groups, prefix=sensor_name + '_')
-        elif sensor_name in ['rotationvector', 'geomagneticrotationvector']:
-            ft = xyz_accuracy_scalar_feature(groups, prefix=sensor_name + '_')
-
-        elif sensor_name in on_change_sensors.keys():
-            column_name = on_change_sensors[sensor_name].get('column', 'status')
-
-            possible_states = sensor[column_name].unique().tolist()
-            possible_states = [str(s) for s in possible_states]
-
-            if len(possible_states) < 2:
-                raise ValueError(f'on-change sensor "{sensor_name}" has only less than 2 states ')
-
-            sensor_user[column_name] = sensor_user[column_name].astype('string')
-            groups = sensor_user.groupby(groupbycolumns, sort=True)
-
-            if groups.size().max() == 0:
-                logger.warning(f'Skip user={user}": all valid windows are empty')
-                continue
-
-            ft = on_change_feature(groups,
-                                   sensor_user,
-                                   sensor_name=sensor_name,
-                                   column_name=column_name,
-                                   states=possible_states,
-                                   prefix=on_change_sensors[sensor_name]['prefix'],
-                                   unknown_state=on_change_sensors[sensor_name].get('unknown_state', None)
-                                   )
-        else:
-            raise ValueError(f"No features defined for the sensor '{sensor_name}'!")
-
-        features.append(ft)
-
-    if len(features) == 0:
-        # raise ValueError('None of the users has features, investigate the reason')
-        logger.info('None of the users has features')
-        logger.info('feature engineering skipped')
-        logger.info(f'Completed in {round(time.time() - start)} [s]')
-        return
-
-    features = pd.concat(features, axis=0)
-    features = features.reset_index(names=['userid', 'experimentid', 'interval'])
-    _intervalindex_to_columns(features)
-    if os.path.splitext(output_path)[-1] == '.csv':
-        Path(output_path).parent.mkdir(parents=True, exist_ok=True)
-        features.to_csv(output_path, index=False)
-    elif os.path.splitext(output_path)[-1] == '.parquet':
-        Path(output_path).parent.mkdir(parents=True, exist_ok=True)
-        features.to_parquet(output_path, engine='pyarrow')
-    else:
-        raise ValueError(f'The output format is not known ({output_path})')
+        with report.stage('write', rows=len(ft), window_size=window_size):
+            if incremental is None:
+                ft = ft.reset_index(names=['userid', 'experimentid', 'interval'])
+                _intervalindex_to_columns(ft)
+            write_features(ft, path)
     logger.info(f'Completed in {round(time.time() - start)} [s]')
 
 
@@ -540,18 +1170,40 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input')
     parser.add_argument('-t', '--timediary', )
-    parser.add_argument('-o', '--output')
+    parser.add_argument('-o', '--output', nargs='+',
+                        help='output path of every window size')
     parser.add_argument('-l', '--logs',
                         help='path to logging file')
-    parser.add_argument('-f', '--window-size', type=int)
+    parser.add_argument('-f', '--window-size', type=int, nargs='+',
+                        help='window sizes in minutes, the features of every window size are computed in one run')
+    parser.add_argument('--hop', type=int, default=None,
+                        help='minutes between the starts of consecutive windows (sliding windows, without time '
+                             'diary), windows overlap if it is smaller than the window size')
     parser.add_argument('-ti', '--timediary_include', type=str, choices=['True', 'False'], default='False',
                         help="Include time diary (True/False)")
+    parser.add_argument('-m', '--memory-budget', type=int, default=None,
+                        help='memory budget in MB, read the sensor in chunks of users that fit in it')
+    parser.add_argument('--incremental', default=None,
+                        help='state directory, compute only the windows after the watermarks of the previous run')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of processes, users are split in shards computed in parallel')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the run with cProfile, the stats are written next to the log (.prof)')
+    parser.add_argument('--cache', default=None,
+                        help='cache directory of the normalized sensors, reused by the next runs')
+    parser.add_argument('--cache-size', type=int, default=None,
+                        help='maximum size of the cache in MB, the least recently used sensors are removed')
 
     args = parser.parse_args()
     logger = get_logger(os.path.basename(__file__), args.logs)
 
     print(args.timediary_include == 'True')
-    main(Path(args.input), Path(args.timediary), Path(args.output), args.window_size, args.timediary_include == 'True')
+    with profiled(Path(args.logs).with_suffix('.prof')) if args.profile else nullcontext():
+        main(Path(args.input), Path(args.timediary), [Path(p) for p in args.output], args.window_size,
+             args.timediary_include == 'True',
+             args.memory_budget, Path(args.incremental) if args.incremental else None, args.workers,
+             Path(args.cache) if args.cache else None, args.cache_size, args.hop)
+    report.write(args.logs, sensor=Path(args.input).stem, window_sizes=args.window_size, workers=args.workers)
 
     # logger = get_logger(os.path.basename(__file__), '/Users/munkhdelger/Knowdive/feature-engineering/logs/ambienttemperature.log')
     # main(Path('/Users/munkhdelger/Knowdive/feature-engineering/data/raw/ambienttemperature.parquet'),
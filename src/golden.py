@@ -0,0 +1,318 @@
+"""
+Equivalence of the outputs of the pipeline with the reference outputs in test/data.
+
+The sensors of test/data/raw are processed by src.feature (without time diary, as the references) and joined by
+src.join_features. Every interim file and the joined features are compared with test/data/interim and
+test/data/processed: rows are matched on userid, experimentid and start_interval whatever their order, float
+features are equal up to a tolerance that depends on the column. An engine is a checkout of the repository, e.g.,
+a git worktree of an older commit. With a baseline engine the outputs of both engines are compared side by side.
+The references have every category of the applications at 0, the category features of the references are replaced
+by the expected ones, computed from the raw applications and the categories of the apps of the engine.
+"""
+import fnmatch
+import json
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.config import sensors_config
+from src.utils.categories import NOT_FOUND, category_column
+from src.utils.interim import INTERVAL_COLUMNS, from_interim_schema, is_parquet
+from src.utils.timestamps import decode_timestamps
+
+RAW_PATH = Path('test', 'data', 'raw')
+INTERIM_PATH = Path('test', 'data', 'interim')
+PROCESSED_PATH = Path('test', 'data', 'processed')
+JOINED_NAME = 'joined_features'
+FILES_TO_IGNORE = ['survey', 'timediary']
+ROW_KEYS = ['userid', 'experimentid', 'start_interval']
+APP_CATEGORIES = Path('src', 'utils', 'appcategories.csv')
+
+# (rtol, atol) of the float features, the first matching pattern is used
+TOLERANCES = [
+    ('*_std*', (1e-5, 1e-8)),  # one pass (moments) and two passes standard deviations
+    ('*radius_of_gyration', (1e-5, 1e-6)),
+    ('*distance_sum', (1e-5, 1e-6)),
+    ('*entropy*', (1e-6, 1e-9)),
+    ('*', (1e-6, 1e-8)),
+]
+# differences with the references that are expected, {file: regular expression of the columns}
+KNOWN_DIFFERENCES = {}
+# category features of the applications, replaced by the expected ones in the references
+CATEGORY_COLUMNS = r'app_(?!nunique$|entropy_basic$).+'
+
+# run by the python of the engine, in its root, the arguments are a JSON object
+DRIVER = """
+import json, logging, sys, traceback
+from pathlib import Path
+import src.feature as feature
+import src.join_features as join_features
+args = json.loads(sys.argv[1])
+logging.basicConfig(filename=args['log'], level=logging.INFO, force=True)
+feature.logger = join_features.logger = logging.getLogger('golden')
+outputs = []
+for sensor in args['sensors']:
+    output = Path(args['interim'], sensor + args['suffix'])
+    try:
+        feature.main(Path(args['raw'], sensor + '.parquet'), Path(args['timediary']), output, args['window_size'],
+                     False, **args['options'])
+    except Exception:
+        traceback.print_exc()
+        print(f'Failed sensor={sensor}')
+    if output.exists():
+        outputs.append(output)
+join_features.main(outputs, Path(args['joined']))
+"""
+
+
+def tolerance(column: str) -> Tuple[float, float]:
+    """(rtol, atol) of the column"""
+    return next(t for pattern, t in TOLERANCES if fnmatch.fnmatchcase(column, pattern))
+
+
+def read_output(path: Path) -> pd.DataFrame:
+    """features of a sensor or joined features, as CSV or typed parquet, with the types used by the pipeline"""
+    if is_parquet(path):
+        return from_interim_schema(pd.read_parquet(path))
+    features = pd.read_csv(path)
+    return from_interim_schema(features.astype({c: 'datetime64[ns]' for c in INTERVAL_COLUMNS
+                                                if c in features.columns}))
+
+
+def _column_record(name: str, column: str, new: pd.Series, reference: pd.Series) -> dict:
+    record = {'file': name, 'column': column, 'rows': len(reference), 'mismatched': 0,
+              'max_abs_diff': np.nan, 'max_rel_diff': np.nan}
+    numeric = pd.api.types.is_numeric_dtype(new) and pd.api.types.is_numeric_dtype(reference) and \
+        not pd.api.types.is_bool_dtype(new) and not pd.api.types.is_bool_dtype(reference)
+    if numeric:
+        rtol, atol = tolerance(column)
+        x, y = new.to_numpy(dtype=float, na_value=np.nan), reference.to_numpy(dtype=float, na_value=np.nan)
+        equal = np.isclose(x, y, rtol=rtol, atol=atol, equal_nan=True)
+        difference = np.abs(x - y)
+        both = ~np.isnan(difference)
+        if both.any():
+            record['max_abs_diff'] = difference[both].max()
+        relative = both & (y != 0)
+        if relative.any():
+            record['max_rel_diff'] = (difference[relative] / np.abs(y[relative])).max()
+        record.update(rtol=rtol, atol=atol)
+    else:
+        equal = (new.isna().to_numpy() & reference.isna().to_numpy()) | \
+                (new.astype(str).to_numpy() == reference.astype(str).to_numpy())
+    record['mismatched'] = int((~equal).sum())
+    record['status'] = 'ok' if record['mismatched'] == 0 else 'different'
+    return record
+
+
+def compare_frames(new: pd.DataFrame, reference: pd.DataFrame, name: str) -> pd.DataFrame:
+    """a row for every column: status (ok, different, missing or extra in new), rows, mismatched rows and largest
+    differences. Rows are matched on the keys, rows only in one of the frames are reported as missing rows and
+    extra rows"""
+    keys = [k for k in ROW_KEYS if k in reference.columns and k in new.columns]
+    new, reference = new.set_index(keys).sort_index(), reference.set_index(keys).sort_index()
+    for frame in [new, reference]:
+        if frame.index.has_duplicates:
+            raise ValueError(f'{name}: rows are not unique on {keys}')
+    common = reference.index.intersection(new.index)
+    records = []
+    for status, rows in [('missing rows', reference.index.difference(new.index)),
+                         ('extra rows', new.index.difference(reference.index))]:
+        if len(rows) > 0:
+            records.append({'file': name, 'column': None, 'status': status, 'rows': len(rows),
+                            'mismatched': len(rows)})
+    for column in reference.columns.union(new.columns, sort=False):
+        if column not in new.columns or column not in reference.columns:
+            records.append({'file': name, 'column': column, 'status': 'missing' if column in reference else 'extra',
+                            'rows': len(common), 'mismatched': len(common)})
+        else:
+            records.append(_column_record(name, column, new.loc[common, column], reference.loc[common, column]))
+    return pd.DataFrame(records)
+
+
+def _find(directory: Path, stem: str) -> Path:
+    """output of the sensor in the directory, parquet or CSV, None if it is missing"""
+    return next((p for p in [Path(directory, f'{stem}.parquet'), Path(directory, f'{stem}.csv')] if p.exists()),
+                None)
+
+
+def compare_outputs(new_dir: Path, reference_dir: Path, sensors: List[str]) -> pd.DataFrame:
+    """compare the interim files and the joined features of two outputs (interim/ and processed/ directories)"""
+    comparisons = []
+    for directory, stems in [('interim', sensors), ('processed', [JOINED_NAME])]:
+        for stem in stems:
+            new_path = _find(Path(new_dir, directory), stem)
+            reference_path = _find(Path(reference_dir, directory), stem)
+            if reference_path is None:
+                continue
+            if new_path is None:
+                comparisons.append(pd.DataFrame([{'file': stem, 'column': None, 'status': 'missing file'}]))
+                continue
+            comparisons.append(compare_frames(read_output(new_path), read_output(reference_path), stem))
+    return pd.concat(comparisons, ignore_index=True)
+
+
+def run_engine(engine: Path, raw_dir: Path, output_dir: Path, sensors: List[str], window_size: int,
+               output_format: str = 'csv', python: str = sys.executable, **options):
+    """process the sensors and join them with the engine, outputs are written in output_dir/interim and
+    output_dir/processed. options are passed to src.feature main, e.g., workers or memory_budget_mb"""
+    output_dir = Path(output_dir).absolute()
+    for directory in ['interim', 'processed']:
+        Path(output_dir, directory).mkdir(parents=True, exist_ok=True)
+    args = {'raw': str(Path(raw_dir).absolute()), 'timediary': str(Path(INTERIM_PATH, 'timediary.csv').absolute()),
+            'interim': str(output_dir / 'interim'), 'suffix': f'.{output_format}',
+            'joined': str(output_dir / 'processed' / f'{JOINED_NAME}.{output_format}'),
+            'log': str(output_dir / 'golden.log'), 'sensors': sensors, 'window_size': window_size,
+            'options': options}
+    subprocess.run([python, '-c', DRIVER, json.dumps(args)], cwd=engine, check=True)
+
+
+@contextmanager
+def worktree(revision: str):
+    """checkout of the revision in a temporary git worktree, with the categories of the applications of this
+    checkout (they are not versioned)"""
+    path = Path(tempfile.mkdtemp(prefix='golden-'), 'engine')
+    subprocess.run(['git', 'worktree', 'add', '--detach', str(path), revision], check=True, capture_output=True)
+    try:
+        if APP_CATEGORIES.exists() and not Path(path, APP_CATEGORIES).exists():
+            shutil.copy(APP_CATEGORIES, Path(path, APP_CATEGORIES))
+        yield path
+    finally:
+        subprocess.run(['git', 'worktree', 'remove', '--force', str(path)], check=True, capture_output=True)
+        shutil.rmtree(path.parent, ignore_errors=True)
+
+
+def expected_app_categories(raw_dir: Path, windows: pd.DataFrame, categories_path: Path) -> pd.DataFrame:
+    """category features of the applications in the windows (userid, experimentid, start_interval, end_interval):
+    the number of categories used (apps that are not in the table count as one category) and whether an app of
+    every category of the table is used, except the categories in columns_to_exclude of src/config.py.
+    Returns one row per window with at least an app, with the keys of ROW_KEYS"""
+    apps = pd.read_parquet(Path(raw_dir, 'applications.parquet'),
+                           columns=['userid', 'experimentid', 'timestamp', 'applicationname'])
+    apps['timestamp'] = decode_timestamps(apps['timestamp'])
+    apps = apps.astype({'userid': 'int64', 'experimentid': str, 'applicationname': object})
+    table = pd.read_csv(categories_path).drop_duplicates()
+    apps = apps.merge(table.rename(columns={'app_id': 'applicationname'}), on='applicationname', how='left')
+    apps['category'] = apps['category'].fillna(NOT_FOUND)
+
+    windows = windows[ROW_KEYS + ['end_interval']].astype({'userid': 'int64', 'experimentid': str})
+    apps = apps.merge(windows, on=['userid', 'experimentid'])
+    apps = apps[(apps['start_interval'] <= apps['timestamp']) & (apps['timestamp'] < apps['end_interval'])]
+    used = pd.crosstab([apps[k] for k in ROW_KEYS], apps['category']) > 0
+
+    excluded = set(sensors_config['application'].get('columns_to_exclude', []))
+    expected = pd.DataFrame({'app_category_nunique': used.sum(axis=1).astype(float)}, index=used.index)
+    for category in table['category'].unique():
+        if category_column(category) not in excluded:
+            expected[category_column(category)] = (used[category] if category in used.columns
+                                                   else pd.Series(False, index=used.index)).astype(float)
+    return expected.reset_index()
+
+
+def replace_app_categories(reference_dir: Path, raw_dir: Path, categories_path: Path):
+    """replace the category features of the references (applications and joined features) in reference_dir with
+    the expected ones, windows without apps have no categories"""
+    for directory, stem in [('interim', 'applications'), ('processed', JOINED_NAME)]:
+        path = _find(Path(reference_dir, directory), stem)
+        if path is None:
+            continue
+        reference = read_output(path)
+        reference = reference.drop(columns=[c for c in reference.columns if re.fullmatch(CATEGORY_COLUMNS, c)])
+        expected = expected_app_categories(raw_dir, reference, categories_path)
+        keys = reference[ROW_KEYS].astype({'userid': 'int64', 'experimentid': str})
+        expected = keys.merge(expected, on=ROW_KEYS, how='left').drop(columns=ROW_KEYS)
+        reference = pd.concat([reference, expected.set_axis(reference.index)], axis=1)
+        if is_parquet(path):
+            reference.to_parquet(path, index=False)
+        else:
+            reference.to_csv(path, index=False)
+
+
+def raw_sensors(raw_dir: Path) -> List[str]:
+    return sorted(p.stem for p in Path(raw_dir).glob('*.parquet') if p.stem not in FILES_TO_IGNORE)
+
+
+def mark_known(comparison: pd.DataFrame) -> pd.DataFrame:
+    """status of the known differences (KNOWN_DIFFERENCES) is known"""
+    known = [comparison['status'].isin(['different', 'missing', 'extra']) & (comparison['file'] == file) &
+             comparison['column'].fillna('').map(lambda column: re.fullmatch(pattern, column) is not None)
+             for file, pattern in KNOWN_DIFFERENCES.items()]
+    if known:
+        comparison.loc[np.logical_or.reduce(known), 'status'] = 'known'
+    return comparison
+
+
+def differences(comparison: pd.DataFrame) -> pd.DataFrame:
+    return comparison[~comparison['status'].isin(['ok', 'known'])]
+
+
+def main(workdir: Path, engine: Path, baseline: Path = None, raw_dir: Path = RAW_PATH, window_size: int = 30,
+         output_format: str = 'csv', strict: bool = False, **options) -> pd.DataFrame:
+    """run the engine (and the baseline engine) on the raw sensors, compare its outputs with the baseline outputs
+    or, without baseline, with the references in test/data (the known differences are reported as known, unless
+    strict). options are passed to the engine only"""
+    sensors = raw_sensors(raw_dir)
+    run_engine(engine, raw_dir, Path(workdir, 'new'), sensors, window_size, output_format, **options)
+    if baseline is None:
+        reference_dir = Path(workdir, 'reference')
+        shutil.rmtree(reference_dir, ignore_errors=True)
+        shutil.copytree(INTERIM_PATH, reference_dir / 'interim')
+        shutil.copytree(PROCESSED_PATH, reference_dir / 'processed')
+        replace_app_categories(reference_dir, raw_dir, Path(engine, APP_CATEGORIES))
+    else:
+        reference_dir = Path(workdir, 'baseline')
+        run_engine(baseline, raw_dir, reference_dir, sensors, window_size, output_format)
+    comparison = compare_outputs(Path(workdir, 'new'), reference_dir, sensors)
+    return mark_known(comparison) if baseline is None and not strict else comparison
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engine', default='.', help='checkout of the repository that is tested')
+    baseline = parser.add_mutually_exclusive_group()
+    baseline.add_argument('--baseline', default=None,
+                          help='checkout of the repository compared with the engine, instead of test/data')
+    baseline.add_argument('--baseline-rev', default=None,
+                          help='git revision compared with the engine, checked out in a temporary worktree')
+    parser.add_argument('--raw', default=str(RAW_PATH), help='raw sensors, with a baseline they can be any sensors')
+    parser.add_argument('--workdir', default=None,
+                        help='directory of the outputs of the engines, by default a temporary directory')
+    parser.add_argument('-o', '--output', default=None, help='path of the CSV report, a row for every column')
+    parser.add_argument('-f', '--window-size', type=int, default=30)
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv', help='format of the interim files')
+    parser.add_argument('--strict', action='store_true', help='known differences with the references are errors')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='workers of the engine')
+    parser.add_argument('-m', '--memory-budget', type=int, default=None, help='memory budget of the engine in MB')
+    args = parser.parse_args()
+
+    options = {k: v for k, v in [('workers', args.workers), ('memory_budget_mb', args.memory_budget)]
+               if v is not None}
+    with worktree(args.baseline_rev) if args.baseline_rev else \
+            nullcontext(Path(args.baseline) if args.baseline else None) as baseline_engine, \
+            tempfile.TemporaryDirectory(prefix='golden-') if args.workdir is None else nullcontext(args.workdir) \
+            as workdir:
+        comparison = main(Path(workdir), Path(args.engine), baseline_engine, Path(args.raw), args.window_size,
+                          args.format, args.strict, **options)
+    if args.output is not None:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        comparison.to_csv(args.output, index=False)
+    different = differences(comparison)
+    files = comparison['file'].nunique()
+    if len(different) == 0:
+        known = comparison['status'] == 'known'
+        print(f'{files} files are equivalent' +
+              (f', {known.sum()} columns with known differences' if known.any() else ''))
+    else:
+        pd.set_option('display.width', 200)
+        print(different.to_string(index=False))
+        print(f'{different["file"].nunique()} of {files} files are different')
+        sys.exit(1)
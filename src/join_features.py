@@ -2,14 +2,31 @@
 Generate the final data set used by SKEL
 """
 import os.path
+import time
+from contextlib import nullcontext
 from pathlib import Path
-from typing import List
+from typing import Iterator, List
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from src.config import sensors_config
-from src.utils.utils import get_logger, _intervalindex_to_columns, parse_interval
+from src.utils.interim import feature_columns, feature_types, iter_features
+from src.utils.profiling import StageReport, profiled
+from src.utils.utils import get_logger
+
+KEYS = ['userid', 'experimentid', 'start_interval', 'end_interval']
+TIME_FEATURES = ['hour', 'sin_hour', 'cos_hour', 'day_period_evening', 'day_period_morning', 'day_period_night',
+                 'day_period_noon']
+# sorted as the dummies of pd.get_dummies
+DAY_PERIODS = ['afternoon', 'evening', 'morning', 'night', 'noon']
+# windows written at once in a parquet output
+ROW_GROUP_ROWS = 100_000
+
+# timing of the join, written next to the log
+report = StageReport()
 
 
 # Some userful references:
@@ -19,17 +36,10 @@ def is_weekday(day):
     return day not in [5, 6]
 
 
-def determine_day_period(hour) -> str:
-    if 6 <= hour < 10:
-        return "morning"
-    if 10 <= hour < 14:
-        return "noon"
-    if 14 <= hour < 18:
-        return "afternoon"
-    if 18 <= hour < 22:
-        return "evening"
-    else:
-        return "night"
+def determine_day_period(hour) -> np.ndarray:
+    return np.select([(6 <= hour) & (hour < 10), (10 <= hour) & (hour < 14), (14 <= hour) & (hour < 18),
+                      (18 <= hour) & (hour < 22)],
+                     ["morning", "noon", "afternoon", "evening"], default="night")
 
 
 def discretize_rssi(value) -> str:
@@ -39,51 +49,127 @@ def discretize_rssi(value) -> str:
     pd.cut(values, bins=[0, 50, 70, 90, np.inf], labels=['good', 'medium', 'bad', 'unusable'], right=True)
 
 
-def get_x(path_to_sensors) -> pd.DataFrame:
-    features_union = None
+def iter_users(sensor_path: Path, columns: List[str]) -> Iterator[pd.DataFrame]:
+    """features of a single sensor, one user at a time. The features must be sorted by userid"""
+    block, previous = [], None
+    for batch in iter_features(sensor_path, columns):
+        users = batch['userid'].to_numpy()
+        if (previous is not None and users[0] < previous) or (np.diff(users) < 0).any():
+            raise ValueError(f'The features are not sorted by userid ({sensor_path})')
+        boundaries = np.flatnonzero(np.diff(users)) + 1
+        for start, end in zip(np.r_[0, boundaries], np.r_[boundaries, len(users)]):
+            if len(block) > 0 and users[start] != previous:
+                yield pd.concat(block, ignore_index=True)
+                block = []
+            block.append(batch.iloc[start:end])
+            previous = users[start]
+    if len(block) > 0:
+        yield pd.concat(block, ignore_index=True)
+
+
+def join_types(path_to_sensors: List[Path]) -> dict:
+    """columns of every sensor and their type in the joined table, without reading the features.
+    Numeric features are float, windows without the sensor are missing"""
+    columns = {}
     for sensor_path in path_to_sensors:
-        logger.info(f'load {sensor_path.name}')
-        sensors = pd.read_csv(
-            sensor_path,
-            parse_dates=['start_interval', 'end_interval']
-        )
         columns_to_exclude = sensors_config.get(sensor_path.stem, {}).get('columns_to_exclude')
-        logger.info(f'exclude columns {columns_to_exclude}')
-        if columns_to_exclude:
-            sensors.drop(columns_to_exclude, inplace=True)
-        types_dict = {'userid': int, 'experimentid': str}
-        for col, col_type in types_dict.items():
-            sensors[col] = sensors[col].astype(col_type)
-
-        sensors['interval'] = parse_interval(sensors)
-        sensors.drop(['start_interval', 'end_interval'], axis=1, inplace=True)
-        sensors.set_index(['userid', 'experimentid', 'interval'], inplace=True)
-
-        if features_union is None:
-            features_union = sensors
-        else:
-            features_union = features_union.join(sensors, how='outer', validate="one_to_one")
-
-    # assert all(features_union[['latitude', 'longitude']].nona())
-    intervals = pd.Series(features_union.index.get_level_values(2))
-    features_union['hour'] = intervals.apply(lambda x: x.mid.hour).values
+        logger.info(f'{sensor_path.name}: exclude columns {columns_to_exclude}')
+        names = [c for c in feature_columns(sensor_path) if c not in (columns_to_exclude or [])]
+        types = feature_types(sensor_path, names)
+        overlap = [c for c in names if any(c in t for t in columns.values())]
+        if len(overlap) > 0:
+            raise ValueError(f'columns overlap {overlap} ({sensor_path})')
+        columns[sensor_path] = {c: t if pd.api.types.is_float_dtype(t) else
+                                'float64' if pd.api.types.is_numeric_dtype(t) else t for c, t in types.items()}
+    return columns
+
+
+def add_time_features(features_union: pd.DataFrame):
+    start, end = features_union['start_interval'], features_union['end_interval']
+    features_union['hour'] = (start + (end - start) / 2).dt.hour.astype('int64')
     # source https://ianlondon.github.io/posts/encoding-cyclical-features-24-hour-time/
     features_union['sin_hour'] = np.sin(2 * np.pi * features_union.hour / 24)
     features_union['cos_hour'] = np.cos(2 * np.pi * features_union.hour / 24)
-    features_union['day_period'] = features_union.hour.apply(determine_day_period)
-    features_union = pd.get_dummies(features_union, columns=['day_period'], drop_first=True)
-
-    return features_union
+    day_period = pd.Categorical(determine_day_period(features_union.hour), categories=DAY_PERIODS)
+    # the first period is dropped as in pd.get_dummies(drop_first=True)
+    for period in DAY_PERIODS[1:]:
+        features_union[f'day_period_{period}'] = day_period == period
+
+
+def join_user(blocks: List[pd.DataFrame], types: dict) -> pd.DataFrame:
+    """outer join of the features of one user, every window once"""
+    for block in blocks:
+        if block.index.has_duplicates:
+            raise ValueError(f'Windows are not unique: {block.index[block.index.duplicated()].unique().tolist()}')
+    features_union = pd.concat(blocks, axis=1, join='outer').sort_index()
+    features_union = features_union.reindex(columns=list(types)).astype(types)
+    features_union = features_union.reset_index()
+    add_time_features(features_union)
+    return features_union[KEYS[:2] + list(types) + TIME_FEATURES + KEYS[2:]]
+
+
+def iter_x(path_to_sensors: List[Path]) -> Iterator[pd.DataFrame]:
+    """k-way merge of the features of all sensors, one user at a time.
+    The features of every sensor are read in batches and must be sorted by userid, only one user of each sensor
+    is in memory"""
+    columns = join_types(path_to_sensors)
+    types = {c: t for sensor_columns in columns.values() for c, t in sensor_columns.items()}
+    readers = {path: iter_users(path, list(columns[path])) for path in path_to_sensors}
+    heads = {path: next(reader, None) for path, reader in readers.items()}
+    heads = {path: head for path, head in heads.items() if head is not None}
+    while len(heads) > 0:
+        user = min(head['userid'].iat[0] for head in heads.values())
+        blocks = []
+        for path in list(heads):
+            if heads[path]['userid'].iat[0] == user:
+                blocks.append(heads.pop(path).set_index(KEYS))
+                head = next(readers[path], None)
+                if head is not None:
+                    heads[path] = head
+        # keep the order of the sensors, i.e., of the columns
+        heads = {path: heads[path] for path in path_to_sensors if path in heads}
+        yield join_user(blocks, types)
+
+
+def get_x(path_to_sensors: List[Path]) -> pd.DataFrame:
+    return pd.concat(iter_x(path_to_sensors), ignore_index=True)
 
 
 def main(path_to_sensors: List[Path], output_path):
     logger.info(f"merge all features for country'")
-
-    X = get_x(path_to_sensors)
-    X = X.reset_index()
-
-    _intervalindex_to_columns(X)
-    X.to_csv(output_path, index=False)
+    report.clear()
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    writer, row_group = None, []
+    # seconds spent joining and writing every user
+    users, tick = [], time.perf_counter()
+    with report.stage('join', sensors=len(path_to_sensors)) as record:
+        for i, X in enumerate(iter_x(path_to_sensors)):
+            joined = time.perf_counter()
+            if os.path.splitext(output_path)[-1] == '.parquet':
+                row_group.append(X)
+                if sum(len(x) for x in row_group) >= ROW_GROUP_ROWS:
+                    writer = write_row_group(pd.concat(row_group, ignore_index=True), output_path, writer)
+                    row_group = []
+            else:
+                X.to_csv(output_path, index=False, mode='w' if i == 0 else 'a', header=i == 0)
+            users.append({'userid': X['userid'].iat[0], 'rows': len(X), 'join_s': joined - tick,
+                          'write_s': time.perf_counter() - joined})
+            tick = time.perf_counter()
+        if len(row_group) > 0:
+            writer = write_row_group(pd.concat(row_group, ignore_index=True), output_path, writer)
+        if writer is not None:
+            writer.close()
+        record['rows'] = sum(user['rows'] for user in users)
+    if len(users) > 0:
+        report.add_users(pd.DataFrame(users))
+
+
+def write_row_group(X: pd.DataFrame, output_path: Path, writer: pq.ParquetWriter = None) -> pq.ParquetWriter:
+    table = pa.Table.from_pandas(X, preserve_index=False)
+    if writer is None:
+        writer = pq.ParquetWriter(output_path, table.schema)
+    writer.write_table(table.cast(writer.schema))
+    return writer
 
 
 if __name__ == '__main__':
@@ -94,10 +180,14 @@ if __name__ == '__main__':
     parser.add_argument('-i', '--input', help='path to the sensor files', nargs='+')
     parser.add_argument('-o', '--output', help='output path')
     parser.add_argument('-l', '--log', help='path to logging file', default='final_data.log')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the run with cProfile, the stats are written next to the log (.prof)')
     args = parser.parse_args()
 
     logger = get_logger(os.path.basename(__file__), args.log)
 
-    main([Path(p) for p in args.input], args.output)
+    with profiled(Path(args.log).with_suffix('.prof')) if args.profile else nullcontext():
+        main([Path(p) for p in args.input], args.output)
+    report.write(args.log, sensors=len(args.input))
     logger.info(f"Done!")
 
@@ -0,0 +1,169 @@
+"""
+Normalization of the joined features.
+
+The columns in normalization of src/config.py are standardized (z-score) and the columns in min_max_normalization are
+scaled to [0, 1], with the statistics of every user or of every study (experimentid). The statistics are mergeable
+moments (src/utils/partial.py) computed in one pass over the batches of the joined features, which are then
+transformed batch by batch: the joined features are never loaded at once. The fitted parameters are stored and reused
+by the next runs, only the users (or studies) without parameters are fitted, e.g., the new users of an incremental run.
+"""
+import os
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Iterator, List
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from src.config import sensors_config
+from src.join_features import write_row_group
+from src.utils.interim import INTERVAL_COLUMNS, from_interim_schema, is_parquet
+from src.utils.partial import MOMENTS, finalize_moments, merge, moments
+from src.utils.profiling import StageReport, profiled
+from src.utils.utils import get_logger
+
+# rows of the joined features read at once
+BATCH_ROWS = 100_000
+GROUPS = ['userid', 'experimentid']
+
+# timing of the normalization, written next to the log
+report = StageReport()
+
+
+def normalized_columns(config: dict = sensors_config) -> dict:
+    """{column: 'zscore' or 'min_max'} of the columns to normalize declared by all the sensors"""
+    methods = {}
+    for sensor_config in config.values():
+        for method, key in [('zscore', 'normalization'), ('min_max', 'min_max_normalization')]:
+            for column in sensor_config.get(key, []):
+                if methods.get(column, method) != method:
+                    raise ValueError(f'{column} is in normalization and in min_max_normalization')
+                methods[column] = method
+    return methods
+
+
+def iter_joined(path: Path, columns: List[str] = None, batch_rows: int = BATCH_ROWS) -> Iterator[pd.DataFrame]:
+    """iterate over the joined features in batches of rows, with columns only the given columns are read"""
+    if is_parquet(path):
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_rows, columns=columns):
+            yield from_interim_schema(batch.to_pandas())
+    else:
+        parse_dates = [c for c in INTERVAL_COLUMNS if columns is None or c in columns]
+        for batch in pd.read_csv(path, usecols=columns, parse_dates=parse_dates, chunksize=batch_rows):
+            yield from_interim_schema(batch)
+
+
+def joined_columns(path: Path) -> List[str]:
+    return pq.read_schema(path).names if is_parquet(path) else pd.read_csv(path, nrows=0).columns.tolist()
+
+
+def fit(path: Path, columns: List[str], by: str, known: pd.Index = None) -> pd.DataFrame:
+    """moments of the columns for every group, merged batch by batch. The groups in known are not fitted.
+    Returns one row per group, columns (column, stat) as in src/utils/partial.py"""
+    fitted = None
+    with report.stage('fit', rows=0, by=by) as record:
+        for batch in iter_joined(path, [by] + columns):
+            if known is not None:
+                batch = batch[~batch[by].isin(known)]
+            record['rows'] += len(batch)
+            if len(batch) == 0:
+                continue
+            partial = {'moments': moments(batch.groupby(by, sort=True), columns)}
+            fitted = partial['moments'] if fitted is None else merge([{'moments': fitted}, partial])['moments']
+    return fitted
+
+
+def read_parameters(path: Path, by: str) -> pd.DataFrame:
+    """fitted moments, None if they are not stored or are fitted on other groups"""
+    if not Path(path).exists():
+        return None
+    parameters = pd.read_parquet(path)
+    if by not in parameters.columns:
+        logger.warning(f'The parameters in {path} are not fitted by {by}, they are fitted again')
+        return None
+    return parameters.set_index([by, 'column'])[MOMENTS].unstack('column').swaplevel(axis=1)
+
+
+def write_parameters(parameters: pd.DataFrame, path: Path):
+    """moments in long format, a row for every group and column"""
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    long = parameters.stack(level=0, future_stack=True).rename_axis([parameters.index.name, 'column'])
+    long[MOMENTS].reset_index().to_parquet(path, index=False)
+
+
+def transform(batch: pd.DataFrame, parameters: pd.DataFrame, methods: dict, by: str) -> pd.DataFrame:
+    """normalized columns of the batch, with the parameters of the group of every row.
+    A constant column (zero standard deviation or range) is only centered"""
+    stats = finalize_moments(parameters).reindex(batch[by].to_numpy())
+    for column, method in methods.items():
+        s = stats[column]
+        if method == 'zscore':
+            center, scale = s['mean'].to_numpy(), s['std'].to_numpy()
+        else:
+            center, scale = s['min'].to_numpy(), (s['max'] - s['min']).to_numpy()
+        scale = np.where(np.isnan(scale) | (scale == 0), 1, scale)
+        batch[column] = (batch[column].to_numpy(dtype=float, na_value=np.nan) - center) / scale
+    return batch
+
+
+def main(input_path: Path, output_path: Path, parameters_path: Path, by: str = 'userid', refit: bool = False):
+    """normalize the joined features in input_path by user or study (by), the parameters are read from and
+    stored in parameters_path"""
+    if by not in GROUPS:
+        raise ValueError(f'The features are normalized by one of {GROUPS}, not by {by}')
+    report.clear()
+    names = joined_columns(input_path)
+    methods = {c: m for c, m in normalized_columns().items() if c in names}
+    logger.info(f'Normalizing {len(methods)} columns by {by}, '
+                f'{sum(m == "zscore" for m in methods.values())} with z-score')
+    columns = list(methods)
+
+    parameters = None if refit else read_parameters(parameters_path, by)
+    if parameters is not None and not set(columns) <= set(parameters.columns.unique(level=0)):
+        logger.warning('The parameters miss some columns, they are fitted again')
+        parameters = None
+    fitted = fit(input_path, columns, by, parameters.index if parameters is not None else None)
+    if fitted is not None:
+        logger.info(f'Fitted the parameters of {len(fitted)} groups by {by}')
+        parameters = fitted if parameters is None else pd.concat([parameters[fitted.columns], fitted])
+        write_parameters(parameters, parameters_path)
+    if parameters is None:
+        logger.info('No features to normalize')
+        return
+
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    writer = None
+    with report.stage('transform', rows=0) as record:
+        for i, batch in enumerate(iter_joined(input_path)):
+            batch = transform(batch, parameters[columns], methods, by)
+            if is_parquet(output_path):
+                writer = write_row_group(batch, output_path, writer)
+            else:
+                batch.to_csv(output_path, index=False, mode='w' if i == 0 else 'a', header=i == 0)
+            record['rows'] += len(batch)
+        if writer is not None:
+            writer.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', help='path of the joined features')
+    parser.add_argument('-o', '--output', help='path of the normalized features')
+    parser.add_argument('-p', '--parameters', help='path of the fitted parameters, reused by the next runs')
+    parser.add_argument('-l', '--log', help='path to logging file', default='normalize.log')
+    parser.add_argument('--by', choices=GROUPS, default='userid',
+                        help='normalize with the statistics of every user or of every study')
+    parser.add_argument('--refit', action='store_true', help='fit the parameters of all the groups again')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the run with cProfile, the stats are written next to the log (.prof)')
+    args = parser.parse_args()
+
+    logger = get_logger(os.path.basename(__file__), args.log)
+
+    with profiled(Path(args.log).with_suffix('.prof')) if args.profile else nullcontext():
+        main(Path(args.input), Path(args.output), Path(args.parameters), args.by, args.refit)
+    report.write(args.log, by=args.by)
+    logger.info('Done!')
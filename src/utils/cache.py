@@ -0,0 +1,87 @@
+"""
+On-disk cache of the normalized sensors.
+
+The normalized sensor (decoded timestamps, sorted by userid and timestamp) is stored as an uncompressed Feather
+file, read with a memory map. The key is the fingerprint of the raw file (size, modification time and a hash of
+its first and last bytes), the sensor name and the version of the normalization: change the version when the
+normalization changes. When the cache is larger than its size, the least recently used files are removed.
+"""
+import hashlib
+import logging
+import os
+from pathlib import Path
+from typing import Callable
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+# bytes hashed at the beginning and at the end of every raw file
+HASHED_BYTES = 2 ** 20
+SUFFIX = '.feather'
+
+
+def _files(path: Path):
+    """files of the raw sensor and their names, a raw sensor is a parquet file or a directory of parquet files"""
+    path = Path(path)
+    if path.is_dir():
+        return [(p, str(p.relative_to(path))) for p in sorted(path.rglob('*')) if p.is_file()]
+    return [(path, path.name)]
+
+
+def fingerprint(path: Path) -> str:
+    """hash of the size, modification time, first and last bytes of every file of the raw sensor"""
+    digest = hashlib.sha256()
+    for file, name in _files(path):
+        stat = file.stat()
+        digest.update(f'{name}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+        with open(file, 'rb') as f:
+            digest.update(f.read(HASHED_BYTES))
+            if stat.st_size > HASHED_BYTES:
+                f.seek(max(stat.st_size - HASHED_BYTES, HASHED_BYTES))
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def cache_path(cache_dir: Path, input_path: Path, sensor_name: str, version: int) -> Path:
+    key = hashlib.sha256(f'{fingerprint(input_path)}:{sensor_name}:{version}'.encode()).hexdigest()[:32]
+    return Path(cache_dir, f'{sensor_name}-{key}{SUFFIX}')
+
+
+def evict(cache_dir: Path, max_size_mb: float, logger: logging.Logger, keep: Path = None):
+    """remove the least recently used files until the cache fits in max_size_mb, keep is never removed"""
+    files = sorted(Path(cache_dir).glob(f'*{SUFFIX}'), key=lambda p: p.stat().st_mtime)
+    size = sum(p.stat().st_size for p in files)
+    for file in files:
+        if size <= max_size_mb * 2 ** 20:
+            break
+        if keep is not None and file == Path(keep):
+            continue
+        size -= file.stat().st_size
+        file.unlink(missing_ok=True)
+        logger.info(f'Evicted {file.name} from the cache')
+
+
+def load_normalized(input_path: Path, sensor_name: str, normalize: Callable[[pd.DataFrame], pd.DataFrame],
+                    cache_dir: Path, version: int, logger: logging.Logger, max_size_mb: float = None,
+                    columns: list = None) -> pd.DataFrame:
+    """normalized sensor, read from the cache or normalized and stored in it.
+    normalize takes the raw sensor and returns the normalized one, only the given columns of the raw sensor are
+    read and stored"""
+    path = cache_path(cache_dir, input_path, sensor_name, version)
+    if path.exists():
+        logger.info(f'Reading the normalized sensor from the cache ({path})')
+        os.utime(path)  # most recently used
+        return feather.read_table(path, memory_map=True).to_pandas()
+
+    sensor = normalize(pd.read_parquet(input_path, columns=columns))
+    sensor = sensor.sort_values(['userid', 'timestamp'], kind='stable', ignore_index=True)
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    # written in a temporary file, a concurrent run never reads a partial file
+    tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+    feather.write_feather(pa.Table.from_pandas(sensor, preserve_index=False), tmp, compression='uncompressed')
+    os.replace(tmp, path)
+    logger.info(f'Stored the normalized sensor in the cache ({path})')
+    if max_size_mb is not None:
+        evict(cache_dir, max_size_mb, logger, keep=path)
+    return sensor
@@ -0,0 +1,36 @@
+"""
+Categories of the applications, loaded once per process
+"""
+from functools import lru_cache
+from pathlib import Path
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+APP_CATEGORIES_PATH = Path('src', 'utils', 'appcategories.csv')
+# category of the applications that are not in the table
+NOT_FOUND = 'app_not-found'
+
+
+@lru_cache(maxsize=None)
+def load_app_categories(path: Path = APP_CATEGORIES_PATH) -> Tuple[pd.Index, np.ndarray, pd.Index]:
+    """app ids, code of the category of every app id and the categories in order of appearance.
+    The last category is NOT_FOUND"""
+    category_db = pd.read_csv(path)
+    category_db.drop_duplicates(inplace=True)
+    category_db.set_index('app_id', verify_integrity=True, inplace=True)
+    codes, categories = pd.factorize(category_db['category'], use_na_sentinel=False)
+    return category_db.index, codes, pd.Index(categories).append(pd.Index([NOT_FOUND]))
+
+
+def category_codes(apps: pd.Index, path: Path = APP_CATEGORIES_PATH) -> np.ndarray:
+    """code of the category of every app, apps that are not in the table have the code of NOT_FOUND"""
+    app_ids, codes, categories = load_app_categories(path)
+    position = app_ids.get_indexer(apps)
+    return np.where(position >= 0, codes[position], len(categories) - 1)
+
+
+def category_column(category) -> str:
+    """name of the feature of the category"""
+    return f'app_{category}'.replace(' ', '_').lower()
@@ -0,0 +1,144 @@
+"""
+State of the incremental feature computation.
+
+For every (userid, experimentid) the state keeps the watermark, i.e., the end of the last closed window, and the
+last reading before the watermark, that is the previous state of on-change sensors for the next window.
+A window is closed when the user has a reading after its end, its features cannot change with new uploads.
+The state directory contains
+ - state.parquet: watermarks and last readings, the possible states of on-change sensors are in the metadata
+ - features.parquet: the features of every window computed so far
+"""
+import json
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from src.utils.stream import open_dataset
+
+KEYS = ['userid', 'experimentid']
+STATES_METADATA = b'possible_states'
+
+
+def load_state(state_dir: Path):
+    """returns the state (one row per userid, experimentid), the possible states and the features computed so far.
+    The state is empty and features are None on the first run"""
+    state_path, features_path = Path(state_dir, 'state.parquet'), Path(state_dir, 'features.parquet')
+    if not state_path.exists():
+        state = pd.DataFrame({'userid': pd.Series(dtype='int64'), 'experimentid': pd.Series(dtype=str),
+                              'watermark': pd.Series(dtype='datetime64[ns]')})
+        return state, None, None
+    table = pq.read_table(state_path)
+    possible_states = (table.schema.metadata or {}).get(STATES_METADATA)
+    if possible_states is not None:
+        possible_states = json.loads(possible_states)
+    features = pd.read_parquet(features_path) if features_path.exists() else None
+    return table.to_pandas(), possible_states, features
+
+
+def save_state(state_dir: Path, state: pd.DataFrame, possible_states: list, features: pd.DataFrame):
+    Path(state_dir).mkdir(parents=True, exist_ok=True)
+    table = pa.Table.from_pandas(state, preserve_index=False)
+    if possible_states is not None:
+        metadata = dict(table.schema.metadata or {})
+        metadata[STATES_METADATA] = json.dumps(possible_states).encode()
+        table = table.replace_schema_metadata(metadata)
+    pq.write_table(table, Path(state_dir, 'state.parquet'))
+    features.to_parquet(Path(state_dir, 'features.parquet'), engine='pyarrow', index=False)
+
+
+def read_new_readings(input_path: Path, state: pd.DataFrame, columns: list = None) -> pd.DataFrame:
+    """read the readings that can be newer than the watermarks, only the given columns are read.
+    The filter is pushed down to parquet on the oldest watermark. Watermarks are local times, the filter is a day
+    earlier to be safe with every time zone, select_new_readings removes the older readings. The filter only applies
+    to the userid, experimentid with a watermark: new users and users without closed windows are read whole.
+    CREP strings ('%m%d%H%M%S%f', the year is 1900) are filtered on their fixed-width month and day: a string is not
+    smaller than the month and day of the threshold if and only if its day is not earlier"""
+    dataset = open_dataset(input_path)
+    timestamp_type = dataset.schema.field('timestamp').type
+    if len(state) == 0 or state['watermark'].isna().any():
+        return dataset.to_table(columns=columns).to_pandas()
+    oldest = state['watermark'].min() - pd.Timedelta(days=1)
+    if pa.types.is_timestamp(timestamp_type):
+        threshold = pa.scalar(oldest.tz_localize('UTC'), type=pa.timestamp('ns', tz='UTC')).cast(timestamp_type)
+    elif (pa.types.is_string(timestamp_type) or pa.types.is_large_string(timestamp_type)) and oldest.year == 1900:
+        threshold = pa.scalar(oldest.strftime('%m%d'), type=timestamp_type)
+    else:
+        return dataset.to_table(columns=columns).to_pandas()
+    return dataset.to_table(columns=columns,
+                            filter=~_has_watermark(state, dataset.schema) | (ds.field('timestamp') >= threshold)) \
+        .to_pandas()
+
+
+def _has_watermark(state: pd.DataFrame, schema: pa.Schema) -> ds.Expression:
+    """expression of the readings of the userid, experimentid in the state, one term per experiment"""
+    userid_type = schema.field('userid').type
+    terms = [(ds.field('experimentid') == experimentid) &
+             ds.field('userid').isin(pa.array(users['userid'].to_numpy(), type=userid_type))
+             for experimentid, users in _keys(state).groupby('experimentid')]
+    expression = terms[0]
+    for term in terms[1:]:
+        expression = expression | term
+    return expression
+
+
+def _keys(df: pd.DataFrame) -> pd.DataFrame:
+    # experimentid is a string in the raw sensors and an object in the stored features
+    return df[KEYS].astype({'userid': 'int64', 'experimentid': str})
+
+
+def _watermark_of(df: pd.DataFrame, state: pd.DataFrame) -> pd.Series:
+    """watermark of the userid, experimentid of every row, NaT if it has no watermark"""
+    watermarks = pd.concat([_keys(state), state['watermark']], axis=1)
+    watermark = _keys(df).merge(watermarks, on=KEYS, how='left')['watermark']
+    return pd.Series(watermark.to_numpy(dtype='datetime64[ns]'), index=df.index)
+
+
+def select_new_readings(sensor: pd.DataFrame, state: pd.DataFrame) -> pd.DataFrame:
+    """readings after the watermark, the last readings before the watermark are added back from the state"""
+    watermark = _watermark_of(sensor, state)
+    sensor = sensor[watermark.isna() | (sensor['timestamp'] >= watermark)]
+    last_readings = state.drop(columns='watermark')
+    if 'timestamp' not in last_readings.columns:
+        return sensor.reset_index(drop=True)
+    last_readings = last_readings[last_readings['timestamp'].notna()]
+    last_readings = last_readings.astype({c: t for c, t in sensor.dtypes.items() if c in last_readings.columns})
+    return pd.concat([last_readings, sensor], ignore_index=True)
+
+
+def drop_closed_windows(features: pd.DataFrame, state: pd.DataFrame) -> pd.DataFrame:
+    """remove the windows before the watermark, they are already in the features computed so far"""
+    watermark = _watermark_of(features, state)
+    return features[watermark.isna() | (features['start_interval'] >= watermark)]
+
+
+def upsert(features: pd.DataFrame, new_features: pd.DataFrame, state: pd.DataFrame) -> pd.DataFrame:
+    """replace the windows after the watermark with the new features"""
+    if features is None:
+        return new_features
+    watermark = _watermark_of(features, state)
+    closed = watermark.notna() & (features['start_interval'] < watermark)
+    features = pd.concat([features[closed], new_features], ignore_index=True)
+    return features.sort_values(KEYS + ['start_interval'], ignore_index=True)
+
+
+def update_state(sensor: pd.DataFrame, windows: pd.DataFrame, state: pd.DataFrame) -> pd.DataFrame:
+    """move the watermark of every userid, experimentid to the end of the last closed window,
+    and keep the last reading before the new watermark"""
+    last_timestamp = sensor.groupby(KEYS, observed=True)['timestamp'].max().rename('last_timestamp').reset_index()
+    closed = last_timestamp.merge(windows, on='userid')
+    closed = closed[closed['end_interval'] <= closed['last_timestamp']]
+    watermark = closed.groupby(KEYS, observed=True)['end_interval'].max().rename('watermark')
+    watermark = pd.concat([_keys(watermark.reset_index()), watermark.reset_index(drop=True)], axis=1)
+
+    # a watermark never goes back
+    watermark = pd.concat([watermark, pd.concat([_keys(state), state['watermark']], axis=1)], ignore_index=True)
+    watermark = watermark.groupby(KEYS)['watermark'].max().dropna().reset_index()
+    watermark['watermark'] = watermark['watermark'].astype('datetime64[ns]')
+
+    sensor = sensor[sensor['timestamp'] < _watermark_of(sensor, watermark)]
+    last_readings = sensor.sort_values('timestamp', kind='stable').groupby(KEYS, observed=True).tail(1)
+    last_readings = pd.concat([_keys(last_readings), last_readings.drop(columns=KEYS)], axis=1)
+    return watermark.merge(last_readings, on=KEYS, how='left')
@@ -0,0 +1,114 @@
+"""
+Typed interim files, i.e., the features of a single sensor and the processed timediary.
+
+Parquet interim files store start_interval and end_interval as int64 (nanoseconds of the local time), userid as int32,
+experimentid as categorical and features as float32. CSV files are still read and written as before.
+"""
+import os
+from pathlib import Path
+from typing import Iterator, List
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+ID_TYPES = {'userid': 'int64', 'experimentid': str}
+INTERVAL_COLUMNS = ['start_interval', 'end_interval']
+# rows read at once when iterating over the features
+BATCH_ROWS = 65_536
+
+
+def is_parquet(path: Path) -> bool:
+    return os.path.splitext(path)[-1] == '.parquet'
+
+
+def to_interim_schema(features: pd.DataFrame) -> pd.DataFrame:
+    """compact types of the features, intervals must be timezone naive"""
+    types = {'userid': 'int32', 'experimentid': 'category'}
+    types.update({c: 'float32' for c in features.select_dtypes('float64').columns})
+    features = features.astype(types)
+    for column in INTERVAL_COLUMNS:
+        features[column] = features[column].astype('datetime64[ns]').astype('int64')
+    return features
+
+
+def from_interim_schema(features: pd.DataFrame) -> pd.DataFrame:
+    """types used by the pipeline, features stay float32"""
+    features = features.astype({c: t for c, t in ID_TYPES.items() if c in features.columns})
+    for column in INTERVAL_COLUMNS:
+        if column in features.columns:
+            features[column] = features[column].astype('datetime64[ns]')
+    return features
+
+
+def write_features(features: pd.DataFrame, output_path: Path):
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    if os.path.splitext(output_path)[-1] == '.csv':
+        features.to_csv(output_path, index=False)
+    elif is_parquet(output_path):
+        to_interim_schema(features).to_parquet(output_path, engine='pyarrow', index=False)
+    else:
+        raise ValueError(f'The output format is not known ({output_path})')
+
+
+def read_features(path: Path, columns: List[str] = None) -> pd.DataFrame:
+    """features of a single sensor, with columns only the given columns (and the keys) are read"""
+    if is_parquet(path):
+        if columns is not None:
+            columns = _with_keys(columns)
+        return from_interim_schema(pd.read_parquet(path, columns=columns))
+    features = pd.read_csv(path, parse_dates=INTERVAL_COLUMNS)
+    if columns is not None:
+        features = features[_with_keys([c for c in columns if c in features.columns])]
+    return from_interim_schema(features)
+
+
+def _with_keys(columns: List[str]) -> List[str]:
+    return list(ID_TYPES) + INTERVAL_COLUMNS + [c for c in columns if c not in ID_TYPES and c not in INTERVAL_COLUMNS]
+
+
+def iter_features(path: Path, columns: List[str], batch_rows: int = BATCH_ROWS) -> Iterator[pd.DataFrame]:
+    """iterate over the features of a single sensor in batches of rows, only the given columns (and the keys)
+    are read"""
+    columns = _with_keys(columns)
+    if is_parquet(path):
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_rows, columns=columns):
+            yield from_interim_schema(batch.to_pandas())
+    else:
+        for batch in pd.read_csv(path, usecols=columns, parse_dates=INTERVAL_COLUMNS, chunksize=batch_rows):
+            yield from_interim_schema(batch[columns])
+
+
+def feature_types(path: Path, columns: List[str]) -> pd.Series:
+    """types of the given columns, read from the parquet schema or guessed on the first rows of a CSV"""
+    if is_parquet(path):
+        types = pq.read_schema(path).empty_table().to_pandas().dtypes
+    else:
+        types = pd.read_csv(path, nrows=BATCH_ROWS).dtypes
+    return types[columns]
+
+
+def feature_columns(path: Path) -> List[str]:
+    """columns of the features of a single sensor, without reading them"""
+    if is_parquet(path):
+        names = pq.read_schema(path).names
+    else:
+        names = pd.read_csv(path, nrows=0).columns.tolist()
+    return [c for c in names if c not in ID_TYPES and c not in INTERVAL_COLUMNS]
+
+
+def write_timediary(timediary: pd.DataFrame, output_path: Path):
+    if is_parquet(output_path):
+        timediary.to_parquet(output_path, engine='pyarrow', index=False)
+    else:
+        timediary.to_csv(output_path, index=False)
+
+
+def read_timediary(path: Path) -> pd.DataFrame:
+    """timediary with local timestamps (timezone removed)"""
+    if is_parquet(path):
+        tddf = pd.read_parquet(path, columns=['userid', 'experimentid', 'timestamp'])
+        tddf['userid'] = tddf['userid'].astype('int64')
+    else:
+        tddf = pd.read_csv(path, parse_dates=['timestamp', 'notificationtimestamp', 'answertimestamp'])
+    tddf['timestamp'] = tddf['timestamp'].dt.tz_localize(None)  # Removes the timezone
+    return tddf
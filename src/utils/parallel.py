@@ -0,0 +1,71 @@
+"""
+Run the feature computation of shards of users on a pool of processes
+"""
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, List
+
+import pandas as pd
+
+from src.utils.stream import partition_users
+
+# shards per worker when there is no memory budget, small shards balance users with different number of readings
+SHARDS_PER_WORKER = 4
+
+
+def shard_users(rows_per_user: pd.Series, workers: int, max_rows: int = None) -> List[list]:
+    """group consecutive users in shards of at most max_rows readings,
+    by default there are about SHARDS_PER_WORKER shards per worker"""
+    if max_rows is None:
+        max_rows = max(int(rows_per_user.sum() / (workers * SHARDS_PER_WORKER)), 1)
+    return partition_users(rows_per_user, max_rows)
+
+
+def _collect(futures: dict, shards: List[list], results: dict, failed: dict, logger: logging.Logger):
+    """store the result of every future in results, shards that raise in failed.
+    Shards of a broken pool are neither in results nor in failed"""
+    for future in as_completed(futures):
+        i = futures[future]
+        try:
+            results[i] = future.result()
+        except BrokenProcessPool:
+            continue
+        except Exception as e:
+            logger.error(f'Failed shard={i} users={shards[i]}: {e!r}')
+            failed[i] = e
+
+
+def run_shards(func: Callable, shards: List[list], workers: int, logger: logging.Logger, args: tuple = (),
+               initializer: Callable = None, initargs: tuple = ()) -> Dict[int, object]:
+    """call func(shard, *args) for every shard on a pool of workers, returns {shard index: result}.
+    A shard that raises is logged and left out of the results, the other shards are not affected.
+    If a worker dies (e.g., killed because out of memory) the whole pool is broken, the unfinished shards are
+    run again each in its own process, so that only the shard that killed its worker fails"""
+    results, failed = {}, {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as pool:
+        futures = {pool.submit(func, shard, *args): i for i, shard in enumerate(shards)}
+        _collect(futures, shards, results, failed, logger)
+
+    pending = [i for i in range(len(shards)) if i not in results and i not in failed]
+    if len(pending) > 0:
+        logger.warning(f'A worker died, running again {len(pending)} shards in isolation')
+    for start in range(0, len(pending), workers):
+        pools, futures = [], {}
+        for i in pending[start:start + workers]:
+            pools.append(ProcessPoolExecutor(max_workers=1, initializer=initializer, initargs=initargs))
+            futures[pools[-1].submit(func, shards[i], *args)] = i
+        _collect(futures, shards, results, failed, logger)
+        for pool in pools:
+            pool.shutdown()
+        for i in pending[start:start + workers]:
+            if i not in results and i not in failed:
+                logger.error(f'Failed shard={i} users={shards[i]}: the worker died')
+                failed[i] = BrokenProcessPool(f'the worker of shard {i} died')
+
+    if len(failed) > 0:
+        users = sum((shards[i] for i in sorted(failed)), [])
+        logger.warning(f'{len(failed)} of {len(shards)} shards failed, skipped users: {users}')
+        if len(results) == 0:
+            raise RuntimeError('All the shards failed') from next(iter(failed.values()))
+    return results
@@ -0,0 +1,159 @@
+"""
+Mergeable partial aggregates of the window features.
+
+A partial aggregate is a dict with
+ - 'moments': one row per window, columns (column, stat) with the stats in MOMENTS
+ - 'counts': {column: number of readings of each value}, indexed by the window keys and the value
+Partial aggregates of the same windows (e.g., computed on different chunks) or of finer windows relabelled to
+coarser ones can be merged in any order, finalizing the merge gives the same features as computing them on all
+the readings at once.
+"""
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+# number of valid readings, mean, sum of squared deviations from the mean, min and max
+MOMENTS = ['count', 'mean', 'm2', 'min', 'max']
+# base of the logarithm of the Shannon entropy
+ENTROPY_BASE = 10
+
+
+def moments(groups, columns: List[str]) -> pd.DataFrame:
+    """moments of the columns for every group"""
+    stats = groups[columns].agg(['count', 'mean', 'var', 'min', 'max']).astype(float)
+    out = {}
+    for column in columns:
+        s = stats[column]
+        m2 = (s['var'] * (s['count'] - 1)).where(s['count'] > 1, 0)
+        out[column] = pd.DataFrame({'count': s['count'], 'mean': s['mean'], 'm2': m2, 'min': s['min'], 'max': s['max']})
+    return pd.concat(out, axis=1)
+
+
+def value_counts(groups, column: str) -> pd.Series:
+    """number of readings of each value of the column for every group, missing values are not counted.
+    The column is factorized once and the (group, value) pairs are counted in one pass"""
+    windows = groups.size().index
+    window = groups.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    value, values = pd.factorize(groups.obj[column])
+    valid = (window >= 0) & (value >= 0)
+    pair, count = np.unique(window[valid] * len(values) + value[valid], return_counts=True)
+    window, value = pair // max(len(values), 1), pair % max(len(values), 1)
+
+    if not isinstance(windows, pd.MultiIndex):
+        windows = pd.MultiIndex.from_arrays([windows])
+    index = pd.MultiIndex(levels=list(windows.levels) + [pd.Index(values)],
+                          codes=[codes[window] for codes in windows.codes] + [value],
+                          names=list(windows.names) + [column], verify_integrity=False)
+    return pd.Series(count, index=index, name='count')
+
+
+def merge_moments(partial: pd.DataFrame, keys: List[str]) -> pd.DataFrame:
+    """merge the moments of the rows with the same keys (Chan et al. parallel algorithm)"""
+    out = {}
+    for column in partial.columns.unique(level=0):
+        m = partial[column]
+        weighted = (m['mean'] * m['count']).fillna(0)
+        groups = pd.DataFrame({'count': m['count'], 'weighted': weighted}).groupby(level=keys, sort=True,
+                                                                                  observed=True)
+        total = groups.sum()
+        mean = total['weighted'] / total['count']
+        # deviation of every partial mean from the merged mean
+        merged_mean = groups['weighted'].transform('sum') / groups['count'].transform('sum')
+        m2 = (m['m2'] + m['count'] * (m['mean'] - merged_mean) ** 2).fillna(0)
+        extremes = m[['min', 'max']].groupby(level=keys, sort=True, observed=True).agg({'min': 'min', 'max': 'max'})
+        out[column] = pd.DataFrame({'count': total['count'],
+                                    'mean': mean,
+                                    'm2': m2.groupby(level=keys, sort=True, observed=True).sum(),
+                                    'min': extremes['min'],
+                                    'max': extremes['max']})
+    return pd.concat(out, axis=1)
+
+
+def merge_counts(counts: pd.Series, keys: List[str]) -> pd.Series:
+    """merge the value counts with the same keys"""
+    value = counts.index.names[-1]
+    return counts.groupby(level=keys + [value], sort=True, observed=True).sum()
+
+
+def merge(partials: List[dict], keys: List[str] = None) -> dict:
+    """merge the partial aggregates, rows with the same keys are combined.
+    By default the keys are all the index levels of the moments"""
+    merged = {}
+    moments_ = [p['moments'] for p in partials if 'moments' in p]
+    if len(moments_) > 0:
+        moments_ = pd.concat(moments_, axis=0)
+        keys = keys if keys is not None else list(moments_.index.names)
+        merged['moments'] = merge_moments(moments_, keys)
+    columns = {c for p in partials for c in p.get('counts', {})}
+    if len(columns) > 0:
+        merged['counts'] = {}
+        for column in sorted(columns):
+            counts = pd.concat([p['counts'][column] for p in partials if column in p.get('counts', {})], axis=0)
+            keys = keys if keys is not None else list(counts.index.names[:-1])
+            merged['counts'][column] = merge_counts(counts, keys)
+    return merged
+
+
+def finalize_moments(partial: pd.DataFrame) -> pd.DataFrame:
+    """count, mean, std, var, min and max of every column, std and var are sample statistics (ddof=1)"""
+    out = {}
+    for column in partial.columns.unique(level=0):
+        m = partial[column]
+        var = (m['m2'] / (m['count'] - 1)).where(m['count'] > 1)
+        out[column] = pd.DataFrame({'count': m['count'], 'mean': m['mean'], 'std': np.sqrt(var), 'var': var,
+                                    'min': m['min'], 'max': m['max']})
+    return pd.concat(out, axis=1)
+
+
+def _as_multiindex(index: pd.Index) -> pd.MultiIndex:
+    return index if isinstance(index, pd.MultiIndex) else pd.MultiIndex.from_arrays([index])
+
+
+def _window_keys(index: pd.MultiIndex, shape: List[int]) -> np.ndarray:
+    # one integer for every combination of the level codes, -1 (missing) included
+    return np.ravel_multi_index([codes + 1 for codes in index.codes], shape)
+
+
+def window_positions(counts: pd.Series, index: pd.Index) -> np.ndarray:
+    """position in index of the window of every count, -1 if the window is not in index.
+    When index has the same levels of the counts (e.g., both come from the same groups) the positions are
+    computed on the codes"""
+    windows, index = _as_multiindex(counts.index.droplevel(-1)), _as_multiindex(index)
+    if index.nlevels != windows.nlevels or \
+            not all(a is b or a.equals(b) for a, b in zip(index.levels, windows.levels)):
+        return index.get_indexer(windows)
+    shape = [len(level) + 1 for level in index.levels]
+    index_keys = _window_keys(index, shape)
+    order = np.argsort(index_keys, kind='stable')
+    keys = _window_keys(windows, shape)
+    position = np.minimum(np.searchsorted(index_keys, keys, sorter=order), max(len(index) - 1, 0))
+    position = order[position] if len(index) > 0 else np.full(len(keys), -1)
+    return np.where(index_keys[position] == keys, position, -1) if len(index) > 0 else position
+
+
+def _windows(counts: pd.Series, index: pd.Index = None):
+    """window number of every count and the windows, counts of windows that are not in index are removed.
+    By default the windows are the ones of the counts"""
+    if index is None:
+        windows = _as_multiindex(counts.index.droplevel(-1))
+        shape = [len(level) + 1 for level in windows.levels]
+        _, first, window = np.unique(_window_keys(windows, shape), return_index=True, return_inverse=True)
+        return counts, window, counts.index.droplevel(-1)[first]
+    window = window_positions(counts, index)
+    return counts[window >= 0], window[window >= 0], index
+
+
+def distinct(counts: pd.Series, index: pd.Index = None) -> pd.Series:
+    """number of distinct values of every window, windows in index without values have 0 distinct values"""
+    counts, window, windows = _windows(counts[counts > 0], index)
+    return pd.Series(np.bincount(window, minlength=len(windows)), index=windows)
+
+
+def entropy(counts: pd.Series, index: pd.Index = None, base: float = ENTROPY_BASE) -> pd.Series:
+    """Shannon entropy of the values of every window, windows in index without values have entropy 0"""
+    counts, window, windows = _windows(counts[counts > 0], index)
+    counts = counts.to_numpy(dtype=float)
+    p = counts / np.bincount(window, weights=counts, minlength=len(windows))[window]
+    return pd.Series(np.bincount(window, weights=-p * np.log(p), minlength=len(windows)) / np.log(base),
+                     index=windows)
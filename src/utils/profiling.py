@@ -0,0 +1,136 @@
+"""
+Timing of the stages of the pipeline.
+
+A stage records wall time, CPU time (of the process and of its terminated children, e.g., the workers of a pool),
+peak RSS and the rows it processed. Stages can be nested, the time of a stage includes its nested stages.
+The report of a run is written next to the log, as JSON (stages, totals per stage name, rows of every user) and
+as CSV (one row per stage).
+"""
+import cProfile
+import json
+import os
+import pstats
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# functions listed in the text summary of the profile
+PROFILE_LINES = 50
+
+
+def _cpu_time() -> float:
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def _peak_rss_mb() -> float:
+    """peak resident set size of the process and of its largest terminated child in MB, None if not available"""
+    if resource is None:
+        return None
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # bytes on macOS, kilobytes on Linux
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+def report_paths(log_path: Path):
+    """paths of the JSON and CSV reports next to the log, e.g., logs/accelerometer.timing.json"""
+    log_path = Path(log_path)
+    return log_path.with_suffix('.timing.json'), log_path.with_suffix('.timing.csv')
+
+
+class StageReport:
+    """stages of a run and the rows of every user"""
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.stages = []
+        self.users = []
+        self.start = time.perf_counter()
+        self._depth = 0
+
+    @contextmanager
+    def stage(self, name: str, rows: int = None, **fields):
+        """time the block, the yielded record can be updated, e.g., with the rows known at the end of the block"""
+        record = {'name': name, 'rows': rows, **fields}
+        start_wall, start_cpu = time.perf_counter(), _cpu_time()
+        record['start_s'] = start_wall - self.start
+        record['depth'] = self._depth
+        self._depth += 1
+        try:
+            yield record
+        finally:
+            self._depth -= 1
+            record['wall_s'] = time.perf_counter() - start_wall
+            record['cpu_s'] = _cpu_time() - start_cpu
+            record['peak_rss_mb'] = _peak_rss_mb()
+            rows = record['rows']
+            record['rows_per_s'] = rows / record['wall_s'] if rows is not None and record['wall_s'] > 0 else None
+            self.stages.append(record)
+
+    def add_users(self, users: pd.DataFrame):
+        """breakdown per user, one row per user (column userid) with counts, e.g., rows and windows"""
+        self.users.append(users)
+
+    def stages_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.stages).sort_values('start_s', kind='stable', ignore_index=True) \
+            if len(self.stages) > 0 else pd.DataFrame()
+
+    def summary(self) -> pd.DataFrame:
+        """totals of the stages with the same name"""
+        stages = self.stages_frame()
+        if len(stages) == 0:
+            return stages
+        summary = stages.groupby('name', sort=False).agg(calls=('name', 'size'), wall_s=('wall_s', 'sum'),
+                                                          cpu_s=('cpu_s', 'sum'), rows=('rows', 'sum'),
+                                                          peak_rss_mb=('peak_rss_mb', 'max'))
+        summary['rows_per_s'] = summary['rows'] / summary['wall_s']
+        return summary
+
+    def users_frame(self) -> pd.DataFrame:
+        """counts of every user summed over the chunks, users with more rows first"""
+        if len(self.users) == 0:
+            return pd.DataFrame()
+        users = pd.concat(self.users, ignore_index=True).groupby('userid').sum()
+        return users.sort_values(users.columns[0], ascending=False).reset_index()
+
+    def write(self, log_path: Path, **fields):
+        """write the JSON and CSV reports next to the log, fields are added to the JSON (e.g., the sensor)"""
+        json_path, csv_path = report_paths(log_path)
+        json_path.parent.mkdir(parents=True, exist_ok=True)
+        stages = self.stages_frame()
+        report = {**fields,
+                  'wall_s': time.perf_counter() - self.start,
+                  'peak_rss_mb': _peak_rss_mb(),
+                  'stages': json.loads(stages.to_json(orient='records')),
+                  'summary': json.loads(self.summary().to_json(orient='index')),
+                  'users': json.loads(self.users_frame().to_json(orient='records'))}
+        with open(json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        stages.to_csv(csv_path, index=False)
+
+
+@contextmanager
+def profiled(path: Path):
+    """profile the block with cProfile, the stats are dumped in path (e.g., for snakeviz) and the most expensive
+    functions by cumulative time in path.txt"""
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield profile
+    finally:
+        profile.disable()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        profile.dump_stats(path)
+        with open(f'{path}.txt', 'w') as f:
+            pstats.Stats(profile, stream=f).sort_stats('cumulative').print_stats(PROFILE_LINES)
@@ -0,0 +1,159 @@
+"""
+Read sensors larger than the available memory in chunks of whole users, or in slices of time of a user
+"""
+import tempfile
+from pathlib import Path
+from typing import Callable, Iterator, List, NamedTuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from src.utils.timestamps import decode_timestamps
+
+# rows used to estimate the in-memory size of a reading
+SAMPLE_ROWS = 10_000
+# processing a chunk needs a few copies of the readings (timestamps, sorting, grouping)
+PROCESSING_OVERHEAD = 4
+# partition column of the readings routed to their chunk
+CHUNK = 'chunk'
+
+
+class Chunk(NamedTuple):
+    """readings of a chunk of users. A user whose readings exceed the budget is split in slices of time, every
+    slice is a chunk of its own: the readings before start are in the previous chunk and the readings from end on
+    are in the next one, start and end are None at the ends of the user"""
+    readings: pd.DataFrame
+    start: pd.Timestamp = None
+    end: pd.Timestamp = None
+
+
+def open_dataset(path: Path) -> ds.Dataset:
+    return ds.dataset(path, format='parquet')
+
+
+def iter_batches(path: Path, columns: List[str] = None) -> Iterator[pd.DataFrame]:
+    """iterate over the record batches of the sensor, only the given columns are read"""
+    for batch in open_dataset(path).to_batches(columns=columns):
+        yield batch.to_pandas()
+
+
+def count_rows_per_user(dataset: ds.Dataset) -> pd.Series:
+    """number of readings of every user, reading only the userid column"""
+    counts = {}
+    for batch in dataset.to_batches(columns=['userid']):
+        for item in pc.value_counts(batch.column('userid')).to_pylist():
+            if item['values'] is not None:
+                counts[item['values']] = counts.get(item['values'], 0) + item['counts']
+    return pd.Series(counts, dtype='int64').sort_index()
+
+
+def count_rows_per_bucket(dataset: ds.Dataset, users: list, bucket_mins: int) -> pd.Series:
+    """number of readings of the given users in every bucket of bucket_mins minutes of local time, reading only the
+    userid and timestamp columns. Returns a Series indexed by userid and bucket start, sorted"""
+    counts = []
+    for batch in dataset.to_batches(columns=['userid', 'timestamp'], filter=ds.field('userid').isin(users)):
+        if batch.num_rows == 0:
+            continue
+        bucket = decode_timestamps(batch.column('timestamp').to_pandas()).dt.floor(f'{bucket_mins}min')
+        counts.append(pd.Series(1, index=pd.MultiIndex.from_arrays([batch.column('userid').to_numpy(), bucket],
+                                                                   names=['userid', 'bucket'])))
+    return pd.concat(counts).groupby(level=['userid', 'bucket']).sum()
+
+
+def estimate_row_size(dataset: ds.Dataset, columns: List[str] = None) -> float:
+    """bytes needed to process one reading, estimated on the first rows of the sensor (of the given columns)"""
+    sample = dataset.head(SAMPLE_ROWS, columns=columns)
+    return sample.nbytes / max(sample.num_rows, 1) * PROCESSING_OVERHEAD
+
+
+def partition_users(rows_per_user: pd.Series, max_rows: int) -> List[list]:
+    """group consecutive users in chunks of at most max_rows readings.
+    A user with more than max_rows readings is alone in its chunk"""
+    chunks = []
+    chunk, chunk_rows = [], 0
+    for user, rows in rows_per_user.items():
+        if len(chunk) > 0 and chunk_rows + rows > max_rows:
+            chunks.append(chunk)
+            chunk, chunk_rows = [], 0
+        chunk.append(user)
+        chunk_rows += rows
+    if len(chunk) > 0:
+        chunks.append(chunk)
+    return chunks
+
+
+def split_user(rows_per_bucket: pd.Series, max_rows: int, is_break: Callable = None) -> list:
+    """starts of the buckets where the readings of a user are cut in slices of at most max_rows readings.
+    A bucket is a cut only if is_break(bucket starts) holds for it, a slice is larger than max_rows until the next
+    bucket that is a break"""
+    breaks = is_break(rows_per_bucket.index.to_numpy()) if is_break is not None else np.ones(len(rows_per_bucket), bool)
+    cuts, rows = [], 0
+    for bucket, bucket_rows, is_cut in zip(rows_per_bucket.index, rows_per_bucket.to_numpy(), breaks):
+        if rows > 0 and rows + bucket_rows > max_rows and is_cut:
+            cuts.append(bucket)
+            rows = 0
+        rows += bucket_rows
+    return cuts
+
+
+def _routed_batches(dataset: ds.Dataset, columns: List[str], users: np.ndarray, first_chunk: np.ndarray,
+                    cuts: dict) -> Iterator[pa.RecordBatch]:
+    """record batches of the sensor with the chunk of every reading: the chunk of its user, plus the slice of the
+    reading for the users that are split"""
+    for batch in dataset.to_batches(columns=columns):
+        userid = batch.column('userid').to_numpy()
+        chunk = first_chunk[np.searchsorted(users, userid)]
+        for user, user_cuts in cuts.items():
+            rows = np.flatnonzero(userid == user)
+            if len(rows) > 0:
+                timestamps = decode_timestamps(batch.column('timestamp').take(rows).to_pandas())
+                chunk[rows] += np.searchsorted(np.asarray(user_cuts, dtype='datetime64[ns]'),
+                                               timestamps.to_numpy(dtype='datetime64[ns]'), side='right')
+        yield batch.append_column(CHUNK, pa.array(chunk, type=pa.int64()))
+
+
+def iter_user_chunks(path: Path, memory_budget_mb: int, columns: List[str] = None, split_mins: int = None,
+                     is_break: Callable = None) -> Iterator[Chunk]:
+    """read the sensor in chunks of whole users whose readings fit in the memory budget.
+    With split_mins a user with more readings than the budget is split in slices of time, cut at multiples of
+    split_mins minutes of local time where is_break(user, times) holds, e.g., not inside a window of the user.
+    The sensor is read once: every reading is routed to the file of its chunk in a temporary directory, then every
+    chunk is read from its file"""
+    dataset = open_dataset(path)
+    rows_per_user = count_rows_per_user(dataset)
+    max_rows = max(int(memory_budget_mb * 2 ** 20 / estimate_row_size(dataset, columns)), 1)
+
+    cuts = {}
+    oversized = rows_per_user.index[rows_per_user > max_rows].tolist() if split_mins is not None else []
+    if len(oversized) > 0:
+        rows_per_bucket = count_rows_per_bucket(dataset, oversized, split_mins)
+        for user in oversized:
+            user_cuts = split_user(rows_per_bucket.loc[user], max_rows,
+                                   (lambda times, user=user: is_break(user, times)) if is_break is not None else None)
+            if len(user_cuts) > 0:
+                cuts[user] = user_cuts
+
+    # (first chunk, bounds of the slices) of every group of users, a user that is split is alone in its group
+    plan, first_chunk = [], []
+    for users in partition_users(rows_per_user, max_rows):
+        bounds = [None] + cuts.get(users[0], []) + [None]
+        first_chunk += [len(plan)] * len(users)
+        plan += [(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+    if len(plan) == 1:
+        yield Chunk(dataset.to_table(columns=columns).to_pandas())
+        return
+
+    with tempfile.TemporaryDirectory(prefix='chunks-') as chunks_dir:
+        routed = _routed_batches(dataset, columns, rows_per_user.index.to_numpy(), np.asarray(first_chunk), cuts)
+        schema = dataset.schema if columns is None else pa.schema([dataset.schema.field(c) for c in columns],
+                                                                   metadata=dataset.schema.metadata)
+        # without threads the readings of every chunk keep the order of the sensor
+        ds.write_dataset(routed, chunks_dir, schema=schema.append(pa.field(CHUNK, pa.int64())), format='parquet',
+                         partitioning=ds.partitioning(pa.schema([(CHUNK, pa.int64())]), flavor='hive'),
+                         use_threads=False, max_partitions=len(plan))
+        for i, (start, end) in enumerate(plan):
+            readings = open_dataset(Path(chunks_dir, f'{CHUNK}={i}')).to_table(columns=columns).to_pandas()
+            yield Chunk(readings, start, end)
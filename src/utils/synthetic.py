@@ -0,0 +1,211 @@
+"""
+Synthetic raw sensors with the schemas of the CREP datasets, e.g., for benchmarks.
+
+Every sensor has experimentid, userid (int16) and timestamp, plus the columns of its family. Readings are uniform
+in the days of the study, sorted by user and timestamp, with a rate in readings per hour of every user. Timestamps
+are typed (Europe/Rome) or strings in the CREP format. The data is random, only the shapes are realistic: users
+have their own devices, places and apps, on-change sensors change state at every reading.
+"""
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from src.utils.timestamps import CREP_FORMAT
+
+EXPERIMENT_ID = 'synthetic'
+START = pd.Timestamp('2024-09-23', tz='Europe/Rome')
+
+XYZ_SENSORS = ['accelerometer', 'gravity', 'gyroscope', 'linearacceleration', 'magneticfield', 'orientation']
+XYZ_UNC_SENSORS = ['accelerometeruncalibrated', 'gyroscopeuncalibrated', 'magneticfielduncalibrated']
+XYZ_ACCURACY_SCALAR_SENSORS = ['geomagneticrotationvector', 'rotationvector']
+# mean and standard deviation of the readings
+VALUE_SENSORS = {'ambienttemperature': (22, 3), 'light': (150, 100), 'pressure': (1013, 5),
+                 'proximity': (2.5, 2.5), 'relativehumidity': (50, 10)}
+ON_CHANGE_STATES = {'screen': ['SCREEN_ON', 'SCREEN_OFF'],
+                    'ringmode': ['mode_normal', 'mode_vibrate', 'mode_silent'],
+                    'airplanemode': [False, True], 'doze': [False, True], 'headsetplug': [False, True],
+                    'music': [False, True], 'userpresence': [False, True]}
+ACTIVITIES = ['InVehicle', 'OnBicycle', 'OnFoot', 'Running', 'Still', 'Tilting', 'Unknown', 'Walking']
+CHARGING_SOURCES = ['charging_ac', 'charging_usb', 'charging_unknown', None]
+APPS = ['com.whatsapp', 'com.instagram.android', 'com.google.android.gm', 'com.google.android.apps.maps',
+        'com.facebook.katana', 'com.spotify.music', 'com.netflix.mediaclient', 'com.tiktok.android',
+        'com.google.android.youtube', 'org.telegram.messenger']
+# distinct devices, places and apps of every user
+POOL_SIZE = 50
+
+# readings per hour of every user
+RATES = {**{sensor: 3600 for sensor in XYZ_SENSORS + XYZ_UNC_SENSORS + XYZ_ACCURACY_SCALAR_SENSORS},
+         **{sensor: 360 for sensor in VALUE_SENSORS},
+         **{sensor: 12 for sensor in ON_CHANGE_STATES},
+         'activities': 30, 'batterycharge': 4, 'location': 60, 'applications': 60, 'bluetooth': 120,
+         'bluetoothnormal': 60, 'bluetoothlowenergy': 120, 'cellularnetwork': 60, 'wifinetworks': 120, 'wifi': 6,
+         'stepcounter': 60, 'stepdetector': 300, 'touch': 600, 'notification': 30, 'batterylevel': 12,
+         'batterymonitoringlog': 12}
+SENSORS = list(RATES)
+
+
+def timestamps(n_readings: np.ndarray, days: int, rng: np.random.Generator, crep: bool = False) -> pd.Series:
+    """sorted timestamps of every user, n_readings[i] readings of user i uniform in the days"""
+    nanoseconds = rng.integers(0, days * 86_400 * 10 ** 9, n_readings.sum())
+    # sorted within every user
+    user = np.repeat(np.arange(len(n_readings)), n_readings)
+    nanoseconds = nanoseconds[np.lexsort((nanoseconds, user))]
+    values = pd.Series(pd.DatetimeIndex(START.tz_convert('UTC').as_unit('ns').value + nanoseconds, tz='UTC')
+                       .tz_convert(START.tz))
+    return to_crep(values) if crep else values
+
+
+def to_crep(values: pd.Series) -> pd.Series:
+    """strings in the CREP format '%m%d%H%M%S%f' of the local time, with microseconds"""
+    local = values.dt.tz_localize(None)
+    microseconds = pa.array(local.to_numpy().view(np.int64) // 1000 % 10 ** 6).cast(pa.string())
+    return pd.Series(pc.binary_join_element_wise(pc.strftime(pa.array(local).cast(pa.timestamp('s'), safe=False),
+                                                             format=CREP_FORMAT.replace('%f', '')),
+                                                 pc.utf8_lpad(microseconds, 6, '0'), '')
+                     .to_numpy(zero_copy_only=False), dtype=object)
+
+
+def _pool(size: int, rng: np.random.Generator) -> np.ndarray:
+    """hashed identifiers, as the addresses and names of the CREP datasets"""
+    return np.array([rng.bytes(32).hex() for _ in range(size)], dtype=object)
+
+
+def _user_choice(user: np.ndarray, pool: np.ndarray, rng: np.random.Generator, per_user: int) -> np.ndarray:
+    """values of the pool, every user uses per_user of them and some much more often than others (Zipf)"""
+    rank = np.minimum(rng.zipf(1.5, len(user)), per_user) - 1
+    return pool[(user * 7919 + rank) % len(pool)]
+
+
+def _states(user: np.ndarray, states: list, rng: np.random.Generator) -> np.ndarray:
+    """states of an on-change sensor, the state changes at every reading"""
+    if len(states) == 2:
+        first = rng.integers(0, 2, user.max() + 1 if len(user) > 0 else 0)
+        position = np.arange(len(user)) - np.searchsorted(user, user)
+        return np.asarray(states, dtype=object)[(first[user] + position) % 2]
+    step = rng.integers(1, len(states), len(user))
+    return np.asarray(states, dtype=object)[np.cumsum(step) % len(states)]
+
+
+def _family_columns(sensor_name: str, user: np.ndarray, rng: np.random.Generator) -> Dict[str, np.ndarray]:
+    n = len(user)
+    if sensor_name in XYZ_SENSORS + XYZ_UNC_SENSORS + XYZ_ACCURACY_SCALAR_SENSORS:
+        columns = {axis: rng.normal(0, 2, n).round(2) for axis in ['x', 'y', 'z']}
+        if sensor_name in XYZ_UNC_SENSORS:
+            columns.update({f'{axis}unc': rng.normal(0, 0.1, n).round(3) for axis in ['x', 'y', 'z']})
+        if sensor_name in XYZ_ACCURACY_SCALAR_SENSORS:
+            columns.update(accuracy=rng.choice([0.0, 1.0, 2.0, 3.0], n), scalar=rng.uniform(-1, 1, n))
+        return columns
+    if sensor_name in VALUE_SENSORS:
+        mean, std = VALUE_SENSORS[sensor_name]
+        return {'value': rng.normal(mean, std, n).round(1)}
+    if sensor_name in ON_CHANGE_STATES:
+        return {'status': _states(user, ON_CHANGE_STATES[sensor_name], rng)}
+    if sensor_name == 'activities':
+        label = _states(user, ACTIVITIES, rng)
+        accuracy = rng.choice([10.0, 100.0], n)
+        return {'label': label, 'accuracy': accuracy,
+                **{a: np.where(label == a, accuracy, 0).astype(np.int64) for a in ACTIVITIES}}
+    if sensor_name == 'batterycharge':
+        source = _states(user, CHARGING_SOURCES, rng)
+        return {'source': source, 'status': pd.notna(source)}
+    if sensor_name == 'location':
+        # places around the home of every user
+        home = rng.uniform([45.0, 10.0], [47.0, 12.0], (user.max() + 1 if n > 0 else 0, 2))
+        place = np.minimum(rng.zipf(1.5, n), 10)
+        offset = rng.normal(0, 0.01, (n, 2)) * place[:, None]
+        return {'accuracy': rng.gamma(2, 8, n), 'bearing': rng.uniform(-180, 180, n),
+                'altitude': rng.integers(200, 1500, n).astype(np.int32),
+                'latitude': (home[user, 0] + offset[:, 0]).round(4),
+                'longitude': (home[user, 1] + offset[:, 1]).round(4),
+                'provider': rng.choice(np.array(['gps', 'network'], dtype=object), n), 'speed': rng.gamma(1.5, 2, n)}
+    if sensor_name == 'applications':
+        apps = np.concatenate([np.asarray(APPS, dtype=object),
+                               np.array([f'com.synthetic.app{i}' for i in range(POOL_SIZE * 4)], dtype=object)])
+        return {'applicationname': _user_choice(user, apps, rng, POOL_SIZE)}
+    if sensor_name in ['bluetooth', 'bluetoothnormal', 'bluetoothlowenergy']:
+        address = _user_choice(user, _pool(POOL_SIZE * 4, rng), rng, POOL_SIZE)
+        return {'address': address, 'bondstate': np.full(n, 'BOND_NONE', dtype=object),
+                'classcode': np.full(n, 7936, dtype=np.int64), 'classtag': np.full(n, 'UNCATEGORIZED', dtype=object),
+                'name': address, 'rssi': rng.normal(-60, 15, n).round(1),
+                'type': rng.choice(np.array(['ble', 'bn'], dtype=object), n)}
+    if sensor_name == 'cellularnetwork':
+        return {'cellid': _user_choice(user, _pool(POOL_SIZE * 4, rng), rng, POOL_SIZE),
+                'dbm': rng.integers(-120, -50, n).astype(float),
+                'type': rng.choice(np.array(['lte', '3g', 'gsm'], dtype=object), n, p=[0.8, 0.15, 0.05])}
+    if sensor_name == 'wifinetworks':
+        address = _user_choice(user, _pool(POOL_SIZE * 4, rng), rng, POOL_SIZE)
+        return {'address': address, 'capabilities': np.full(n, 'WPA2-PSK-CCMP, ESS', dtype=object),
+                'frequency': rng.choice([2412.0, 2437.0, 2462.0, 5180.0], n), 'name': address,
+                'rssi': rng.normal(-70, 10, n).round(0)}
+    if sensor_name == 'wifi':
+        bssid = _user_choice(user, _pool(POOL_SIZE, rng), rng, 5)
+        return {'bssid': bssid, 'isconnected': rng.random(n) < 0.6, 'ssid': bssid}
+    if sensor_name == 'stepcounter':
+        # cumulative counter of every user
+        steps = rng.poisson(20, n).astype(float)
+        total = np.cumsum(steps)
+        first = np.searchsorted(user, user)
+        return {'value': 90000 + total - (total - steps)[first]}
+    if sensor_name in ['stepdetector', 'touch']:
+        return {}
+    if sensor_name == 'notification':
+        return {'identifier': rng.integers(0, 100, n), 'isclearable': rng.random(n) < 0.5,
+                'isongoing': rng.random(n) < 0.1,
+                'package': _user_choice(user, np.asarray(APPS, dtype=object), rng, 5),
+                'status': _states(user, ['notification_posted', 'notification_removed'], rng)}
+    if sensor_name in ['batterylevel', 'batterymonitoringlog']:
+        # discharges and recharges of about a day
+        position = np.arange(n) - np.searchsorted(user, user)
+        return {'level': (100 - (position % 24) * 4 + rng.normal(0, 1, n)).clip(0, 100).round(1),
+                'scale': np.full(n, 100.0)}
+    raise ValueError(f'Unknown sensor {sensor_name}')
+
+
+def generate_sensor(sensor_name: str, users: int, days: int, rate: float = None, seed: int = 0,
+                    crep_timestamps: bool = False) -> pd.DataFrame:
+    """raw readings of the sensor, rate is in readings per hour of every user (by default RATES[sensor_name])"""
+    rng = np.random.default_rng([seed, SENSORS.index(sensor_name) if sensor_name in SENSORS else len(SENSORS)])
+    rate = RATES[sensor_name] if rate is None else rate
+    n_readings = np.full(users, int(round(rate * 24 * days)))
+    user = np.repeat(np.arange(users), n_readings)
+    sensor = pd.DataFrame({'experimentid': EXPERIMENT_ID,
+                           'userid': user.astype(np.int16),
+                           'timestamp': timestamps(n_readings, days, rng, crep_timestamps)})
+    for column, values in _family_columns(sensor_name, user, rng).items():
+        sensor[column] = values
+    return sensor
+
+
+def generate_timediary(users: int, days: int, every_mins: int = 30, crep_timestamps: bool = False) -> pd.DataFrame:
+    """raw timediary, a time diary question every every_mins minutes from 8:00 to 22:00. CREP timestamps do not
+    have the year, the timediary has the same format of the sensors"""
+    times = pd.date_range(START, periods=days * 24 * 60 // every_mins, freq=f'{every_mins}min')
+    times = times[(times.hour >= 8) & (times.hour < 22)]
+    timediary = pd.DataFrame({'userid': np.repeat(np.arange(users), len(times)).astype(np.int16),
+                              'experimentid': EXPERIMENT_ID,
+                              'timestamp': np.tile(times, users),
+                              'tag': 'time_diary'})
+    timediary['questionnaireid'] = 'time_diary_' + timediary['timestamp'].dt.strftime('%Y%m%d%H%M%S%f')
+    if crep_timestamps:
+        timediary['timestamp'] = to_crep(timediary['timestamp'])
+    return timediary
+
+
+def write_dataset(raw_dir: Path, sensors: List[str], users: int, days: int, rate_scale: float = 1,
+                  rates: Dict[str, float] = None, seed: int = 0, crep_timestamps: bool = False) -> Dict[str, int]:
+    """write raw_dir/<sensor>.parquet of every sensor and raw_dir/timediary.parquet, returns the rows of every sensor.
+    The rates of RATES are multiplied by rate_scale, rates overrides them"""
+    Path(raw_dir).mkdir(parents=True, exist_ok=True)
+    rows = {}
+    for sensor_name in sensors:
+        rate = (rates or {}).get(sensor_name, RATES[sensor_name] * rate_scale)
+        sensor = generate_sensor(sensor_name, users, days, rate, seed, crep_timestamps)
+        sensor.to_parquet(Path(raw_dir, f'{sensor_name}.parquet'), engine='pyarrow', index=False)
+        rows[sensor_name] = len(sensor)
+    timediary = generate_timediary(users, days, crep_timestamps=crep_timestamps)
+    timediary.to_parquet(Path(raw_dir, 'timediary.parquet'), engine='pyarrow', index=False)
+    return rows
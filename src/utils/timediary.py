@@ -0,0 +1,94 @@
+"""
+Window index of the time diary, shared by all the sensors.
+
+The index has the answers of every user as int64 timestamps (nanoseconds of the local time, floored to the second),
+sorted by user and time, with the users and the offset of their answers: the answers of users[i] are
+timestamps[offsets[i]:offsets[i + 1]]. The window of an answer spans half the window size before and after it, so
+the breaks of every window size are computed from the same index. It is written by src.contribution next to the
+processed time diary as an uncompressed Feather file (users and offsets in the schema metadata), the sensors read
+it with a memory map instead of parsing the time diary.
+"""
+import os
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from src.utils.interim import read_timediary
+
+SUFFIX = '.index.feather'
+
+
+class TimediaryIndex(NamedTuple):
+    users: np.ndarray
+    offsets: np.ndarray
+    timestamps: np.ndarray
+
+
+def index_path(timediary_path: Path) -> Path:
+    """path of the index next to the processed time diary, e.g., data/interim/timediary.index.feather"""
+    timediary_path = Path(timediary_path)
+    return timediary_path.with_name(timediary_path.name.split('.')[0] + SUFFIX)
+
+
+def build_index(tddf: pd.DataFrame) -> TimediaryIndex:
+    """index of the time diary as returned by read_timediary (local timestamps without timezone)"""
+    userid = tddf['userid'].to_numpy(dtype=np.int64)
+    timestamp = tddf['timestamp'].dt.floor('s').to_numpy(dtype='datetime64[ns]').view(np.int64)
+    order = np.lexsort((timestamp, userid))
+    userid, timestamp = userid[order], timestamp[order]
+    starts = np.flatnonzero(np.r_[True, userid[1:] != userid[:-1]]) if len(userid) > 0 else np.zeros(0, np.int64)
+    return TimediaryIndex(userid[starts], np.r_[starts, len(userid)].astype(np.int64), timestamp)
+
+
+def write_index(index: TimediaryIndex, path: Path):
+    table = pa.table({'timestamp': pa.array(index.timestamps, type=pa.int64())},
+                     metadata={'users': index.users.astype('<i8').tobytes(),
+                               'offsets': index.offsets.astype('<i8').tobytes()})
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    # a single record batch is read without copies, a concurrent run never reads a partial file
+    tmp = Path(path).with_suffix(f'.{os.getpid()}.tmp')
+    feather.write_feather(table, tmp, compression='uncompressed', chunksize=max(len(index.timestamps), 1))
+    os.replace(tmp, path)
+
+
+def read_index(path: Path) -> TimediaryIndex:
+    """index read with a memory map, the timestamps are not copied"""
+    table = feather.read_table(path, memory_map=True)
+    metadata = table.schema.metadata
+    column = table.column('timestamp')
+    timestamps = column.chunk(0).to_numpy() if column.num_chunks == 1 else column.to_numpy()
+    return TimediaryIndex(np.frombuffer(metadata[b'users'], dtype='<i8'),
+                          np.frombuffer(metadata[b'offsets'], dtype='<i8'), timestamps)
+
+
+def load_index(timediary_path: Path) -> TimediaryIndex:
+    """index next to the processed time diary, built from the time diary if it is missing or older"""
+    path = index_path(timediary_path)
+    if path.exists() and path.stat().st_mtime_ns >= Path(timediary_path).stat().st_mtime_ns:
+        return read_index(path)
+    return build_index(read_timediary(timediary_path))
+
+
+def diary_windows(index: TimediaryIndex, users: np.ndarray, window_size_mins: int) -> pd.DataFrame:
+    """windows of the answers of the given users, [answer - window / 2, answer + window / 2) with the half window
+    in whole minutes. Users without answers have no windows, the windows of a user must not overlap.
+    Returns one row per window (userid, start_interval, end_interval), sorted by userid and start_interval"""
+    users = np.sort(np.asarray(users))
+    position = np.minimum(np.searchsorted(index.users, users), max(len(index.users) - 1, 0))
+    found = (index.users[position] == users) if len(index.users) > 0 else np.zeros(len(users), dtype=bool)
+    users, position = users[found], position[found]
+    lo, n = index.offsets[position], index.offsets[position + 1] - index.offsets[position]
+    rows = np.repeat(lo - (np.cumsum(n) - n), n) + np.arange(n.sum())
+    answer = index.timestamps[rows]
+    userid = np.repeat(users, n)
+
+    half = int(pd.Timedelta(minutes=int(window_size_mins / 2)).value)
+    start, end = answer - half, answer + half
+    # windows are closed on the left, consecutive windows of a user can share a break
+    assert not np.any((userid[1:] == userid[:-1]) & (start[1:] < end[:-1]))
+    return pd.DataFrame({'userid': userid, 'start_interval': start.view('datetime64[ns]'),
+                         'end_interval': end.view('datetime64[ns]')})
@@ -0,0 +1,91 @@
+"""
+Decoding of the timestamps of the raw sensors.
+
+Raw timestamps are either typed (datetime, possibly with a timezone, or an Arrow timestamp) or strings in the
+CREP format '%m%d%H%M%S%f'. Strings are decoded arithmetically on their bytes, as pd.to_datetime does the year is
+1900 and the fraction has up to 9 digits.
+"""
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+CREP_FORMAT = '%m%d%H%M%S%f'
+# characters of month, day, hour, minute and second
+CREP_FIELDS = 10
+MAX_FRACTION_DIGITS = 9
+
+
+def _crep_bytes(values: pd.Series):
+    """bytes of the strings as a (strings, characters) matrix, padded with zeros, and the missing strings.
+    Returns None if a string is not ASCII or does not have a valid length"""
+    array = pa.array(values.array if isinstance(values.dtype, pd.StringDtype) else values.to_numpy(),
+                     type=pa.string(), from_pandas=True)
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+    missing = array.is_null().to_numpy(zero_copy_only=False)
+    array = pc.fill_null(array, '01010000000')
+    lengths = pc.binary_length(array).to_numpy()
+    if len(array) == 0 or lengths.min() < CREP_FIELDS or lengths.max() > CREP_FIELDS + MAX_FRACTION_DIGITS or \
+            not pc.all(pc.string_is_ascii(array)).as_py():
+        return None, missing
+    offsets = np.frombuffer(array.buffers()[1], dtype=np.int32)[array.offset:array.offset + len(array) + 1]
+    data = np.frombuffer(array.buffers()[2], dtype=np.uint8)
+    if lengths.min() == lengths.max():
+        # fixed width, the strings are a view of the data buffer
+        chars = data[offsets[0]:offsets[-1]].reshape(len(array), lengths[0])
+        return np.pad(chars, ((0, 0), (0, CREP_FIELDS + MAX_FRACTION_DIGITS - lengths[0]))), missing
+    chars = np.asarray(array.to_numpy(zero_copy_only=False), dtype=f'S{CREP_FIELDS + MAX_FRACTION_DIGITS}')
+    return chars.view(np.uint8).reshape(len(array), -1), missing
+
+
+def _decode_crep(values: pd.Series) -> pd.Series:
+    """decode strings in the CREP format, falls back to pd.to_datetime (which raises) if a string is not valid"""
+    chars, missing = _crep_bytes(values)
+    if chars is None:
+        return pd.to_datetime(values, format=CREP_FORMAT)
+    digits = chars.astype(np.int16) - ord('0')
+    # the fraction is padded with zeros on the right, it has at least one digit
+    fraction = digits[:, CREP_FIELDS:]
+    padding = fraction == -ord('0')
+    fraction = np.where(padding, 0, fraction)
+    if (digits[:, :CREP_FIELDS] < 0).any() or (digits[:, :CREP_FIELDS] > 9).any() or \
+            ((fraction < 0) | (fraction > 9)).any() or padding[:, 0].any():
+        return pd.to_datetime(values, format=CREP_FORMAT)
+
+    month, day, hour, minute, second = (digits[:, i].astype(np.int64) * 10 + digits[:, i + 1]
+                                        for i in range(0, CREP_FIELDS, 2))
+    month_start = np.datetime64('1900-01', 'M') + (month - 1)
+    date = month_start.astype('datetime64[D]') + (day - 1)
+    valid = (month >= 1) & (month <= 12) & (day >= 1) & (date.astype('datetime64[M]') == month_start) & \
+            (hour < 24) & (minute < 60) & (second < 60)
+    if not valid.all():
+        return pd.to_datetime(values, format=CREP_FORMAT)
+
+    nanoseconds = fraction.astype(np.int64) @ 10 ** np.arange(MAX_FRACTION_DIGITS - 1, -1, -1, dtype=np.int64)
+    timestamps = date.astype('datetime64[ns]') + (((hour * 60 + minute) * 60 + second) * 10 ** 9 + nanoseconds)
+    timestamps[missing] = np.datetime64('NaT')
+    return pd.Series(timestamps, index=values.index, name=values.name)
+
+
+def decode_timestamps(values: pd.Series, local: bool = True) -> pd.Series:
+    """timestamps as datetime64[ns]. With local the timezone is removed in the same step, i.e., timestamps are in
+    the local time of the readings, otherwise the timezone of typed timestamps is kept"""
+    dtype = values.dtype
+    if isinstance(dtype, pd.ArrowDtype) and pa.types.is_timestamp(dtype.pyarrow_dtype):
+        array = pa.array(values.array)
+        if local and dtype.pyarrow_dtype.tz is not None:
+            array = pc.local_timestamp(array)
+        elif dtype.pyarrow_dtype.tz is not None:
+            array = array.cast(pa.timestamp(dtype.pyarrow_dtype.unit))
+        values = pd.Series(array.to_numpy(zero_copy_only=False), index=values.index, name=values.name)
+        if dtype.pyarrow_dtype.tz is not None and not local:
+            values = values.dt.tz_localize('UTC').dt.tz_convert(dtype.pyarrow_dtype.tz)
+        dtype = values.dtype
+    if isinstance(dtype, pd.DatetimeTZDtype):
+        if local:
+            values = values.dt.tz_localize(None)  # Removes the timezone
+        return values if values.dt.unit == 'ns' else values.dt.as_unit('ns')
+    if pd.api.types.is_datetime64_dtype(dtype):
+        return values if values.dt.unit == 'ns' else values.dt.as_unit('ns')
+    return _decode_crep(values)
@@ -1,24 +1,43 @@
 import logging
-import os
 import sys
 import pandas as pd
 import random
 
 # =============================== UTILS FOR FEATURE ENGINEERING =======================
 
-from math import sin, cos, atan2, sqrt, pi
+from math import pi
 import numpy as np
-from geopy.distance import great_circle
-from shapely.geometry import MultiPoint
 
 # earth's mean radius = 6,371km
 earthradius = 6371.0
 
 
+def great_circle_angle(lat1, lon1, lat2, lon2):
+    """central angle between points in degrees, arrays are broadcast.
+    Same formula of geopy great_circle, numerically accurate also for close points"""
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    sin_lat1, cos_lat1 = np.sin(lat1), np.cos(lat1)
+    sin_lat2, cos_lat2 = np.sin(lat2), np.cos(lat2)
+    delta_lon = lon2 - lon1
+    cos_delta_lon, sin_delta_lon = np.cos(delta_lon), np.sin(delta_lon)
+    return np.arctan2(np.sqrt((cos_lat2 * sin_delta_lon) ** 2 +
+                              (cos_lat1 * sin_lat2 - sin_lat1 * cos_lat2 * cos_delta_lon) ** 2),
+                      sin_lat1 * sin_lat2 + cos_lat1 * cos_lat2 * cos_delta_lon)
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """haversine distance in km between points in degrees, arrays are broadcast"""
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.0) ** 2
+    return earthradius * 2.0 * np.arctan2(np.sqrt(a), np.sqrt(1.0 - a))
+
+
 def centermost_point(cluster):
-    centroid = (MultiPoint(cluster).centroid.x, MultiPoint(cluster).centroid.y)
-    centermost_point = min(cluster, key=lambda point: great_circle(point, centroid).m)
-    return centermost_point  # ['latitude', 'longitude'])
+    """point of the cluster closest to its centroid, the first one in case of ties"""
+    cluster = np.asarray(cluster, dtype=float)
+    centroid = cluster.mean(axis=0)
+    distance = great_circle_angle(cluster[:, 0], cluster[:, 1], centroid[0], centroid[1])
+    return tuple(cluster[np.argmin(distance)])  # ['latitude', 'longitude'])
 
 
 def getDistanceByHaversine(loc1, loc2):
@@ -47,15 +66,39 @@ def radius_of_gyration(x):
     # source https://github.com/scikit-mobility/scikit-mobility/blob/e9c32bd1ca51d7fe691ed05db59483e87654a164/skmob/measures/individual.py#L12
     lats_lngs = x[['latitude', 'longitude']].values
     center_of_mass = np.mean(lats_lngs, axis=0)
-    rg = np.sqrt(np.mean([getDistanceByHaversine((lat, lng), center_of_mass) ** 2.0 for lat, lng in lats_lngs]))
-    return rg
+    return np.sqrt(np.mean(haversine(lats_lngs[:, 0], lats_lngs[:, 1], center_of_mass[0], center_of_mass[1]) ** 2))
 
 
 def get_total_distance_covered(x):
     # [source](https://github.com/scikit-mobility/scikit-mobility/blob/e9c32bd1ca51d7fe691ed05db59483e87654a164/skmob/measures/individual.py#L465)
     lats_lngs = x.sort_values(by='timestamp')[['latitude', 'longitude']].values
-    lengths = np.array([getDistanceByHaversine(lats_lngs[i], lats_lngs[i - 1]) for i in range(1, len(lats_lngs))])
-    return np.sum(lengths)
+    return np.sum(haversine(lats_lngs[1:, 0], lats_lngs[1:, 1], lats_lngs[:-1, 0], lats_lngs[:-1, 1]))
+
+
+def mobility_features(group: np.ndarray, latitude: np.ndarray, longitude: np.ndarray) -> dict:
+    """centermost point, radius of gyration and total distance of every group in one pass.
+    group are the group numbers (0, ..., n-1) of readings sorted by group and timestamp"""
+    n = group[-1] + 1 if len(group) > 0 else 0
+    count = np.bincount(group, minlength=n)
+    mean_latitude = np.bincount(group, weights=latitude, minlength=n) / count
+    mean_longitude = np.bincount(group, weights=longitude, minlength=n) / count
+
+    # centermost point, the first minimum of every group
+    distance = great_circle_angle(latitude, longitude, mean_latitude[group], mean_longitude[group])
+    distance = np.where(np.isnan(distance), np.inf, distance)
+    order = np.lexsort((np.arange(len(group)), distance, group))
+    first = np.r_[0, np.cumsum(count)[:-1]]
+    centermost = order[first]
+
+    rog = np.sqrt(np.bincount(group, weights=haversine(latitude, longitude, mean_latitude[group],
+                                                          mean_longitude[group]) ** 2, minlength=n) / count)
+
+    # distance between consecutive readings of the same group
+    same_group = group[1:] == group[:-1]
+    steps = haversine(latitude[1:], longitude[1:], latitude[:-1], longitude[:-1])
+    total = np.bincount(group[1:][same_group], weights=steps[same_group], minlength=n)
+    return {'latitude': latitude[centermost], 'longitude': longitude[centermost], 'radius_of_gyration': rog,
+            'distance_sum': total}
 
 
 def set_seed(seed=42):
@@ -67,17 +110,21 @@ def set_seed(seed=42):
 
 ###
 
+def to_intervalindex(intervals) -> pd.IntervalIndex:
+    """intervals as IntervalIndex, categorical intervals are converted through their categories"""
+    if isinstance(intervals.dtype, pd.CategoricalDtype):
+        return pd.IntervalIndex(intervals.cat.categories).take(intervals.cat.codes.to_numpy())
+    return pd.IntervalIndex(intervals)
+
+
 def _intervalindex_to_columns(df):
-    df[['start_interval', 'end_interval']] = df.apply(
-        func=lambda row: [row['interval'].left, row['interval'].right],
-        result_type='expand',
-        axis=1)
-    df.pop('interval')
+    intervals = to_intervalindex(df.pop('interval'))
+    df['start_interval'] = intervals.left
+    df['end_interval'] = intervals.right
 
 
 def parse_interval(df):
-    return df.apply(
-        lambda row: pd.Interval(row['start_interval'], row['end_interval'], closed='left'), axis=1)
+    return pd.IntervalIndex.from_arrays(df['start_interval'], df['end_interval'], closed='left')
 
 
 def get_logger(name, filename, level=logging.INFO):
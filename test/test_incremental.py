@@ -0,0 +1,43 @@
+import logging
+
+import pandas as pd
+import pytest
+
+import src.feature as feature
+from src.utils.synthetic import to_crep
+
+RAW = 'test/data/raw/screen.parquet'
+TIMEDIARY = 'test/data/interim/timediary.csv'
+
+feature.logger = logging.getLogger('test')
+
+
+def run(raw: pd.DataFrame, directory, state_dir=None) -> pd.DataFrame:
+    """features of the raw readings, written in directory"""
+    path = directory / 'screen.parquet'
+    path.mkdir(parents=True)
+    raw.to_parquet(path / 'part.0.parquet', index=False)
+    feature.main(path, TIMEDIARY, directory / 'screen.csv', 30, False, incremental=state_dir)
+    return pd.read_csv(directory / 'screen.csv').sort_values(['userid', 'start_interval'], ignore_index=True)
+
+
+@pytest.mark.parametrize('crep', [False, True])
+def test_new_users(tmp_path, crep):
+    """a user without a closed window in the first run and a user that shows up in the second run have all their
+    readings in the second run"""
+    raw = pd.read_parquet(RAW).sort_values(['userid', 'timestamp'], ignore_index=True)
+    late = raw[raw['userid'] == 1].assign(userid=raw['userid'].dtype.type(2))
+    raw = pd.concat([raw, late], ignore_index=True)
+    if crep:
+        raw['timestamp'] = to_crep(raw['timestamp'])
+    # user 0 has half of its readings, user 1 only its first reading (no closed window) and user 2 is missing
+    first = pd.concat([raw[raw['userid'] == 0].iloc[:len(raw[raw['userid'] == 0]) // 2],
+                       raw[raw['userid'] == 1].iloc[:1]])
+
+    state_dir = tmp_path / 'state'
+    run(first, tmp_path / 'first', state_dir)
+    incremental = run(raw, tmp_path / 'second', state_dir)
+    full = run(raw, tmp_path / 'full')
+
+    assert set(incremental['userid']) == {0, 1, 2}
+    pd.testing.assert_frame_equal(incremental[full.columns], full, check_dtype=False)
@@ -0,0 +1,38 @@
+import logging
+
+import pandas as pd
+import pytest
+
+import src.feature as feature
+
+TIMEDIARY = 'test/data/interim/timediary.csv'
+
+feature.logger = logging.getLogger('test')
+
+
+def run(raw: pd.DataFrame, directory, window_sizes: list, memory_budget_mb=None) -> list:
+    """features of the raw readings for every window size, written in directory"""
+    path = directory / 'light.parquet'
+    path.mkdir(parents=True)
+    raw.to_parquet(path / 'part.0.parquet', index=False)
+    outputs = [directory / f'light_{window_size}.csv' for window_size in window_sizes]
+    feature.main(path, TIMEDIARY, outputs, window_sizes, False, memory_budget_mb)
+    return [pd.read_csv(output).sort_values(['userid', 'start_interval'], ignore_index=True) for output in outputs]
+
+
+@pytest.mark.parametrize('window_sizes', [[30], [30, 60]])
+def test_split_on_a_reading(tmp_path, window_sizes):
+    """a user larger than the budget is split in slices, the readings on the breaks of the windows are kept"""
+    timestamp = pd.to_datetime(['2024-10-01 10:00', '2024-10-01 10:12', '2024-10-01 10:30', '2024-10-01 11:00',
+                                '2024-10-01 11:20', '2024-10-01 12:05']).tz_localize('Europe/Rome')
+    raw = pd.DataFrame({'experimentid': 'test', 'userid': 0, 'timestamp': timestamp,
+                        'value': [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]})
+    raw = pd.concat([raw, raw.assign(userid=1)], ignore_index=True)
+
+    full = run(raw, tmp_path / 'full', window_sizes)
+    # one reading per chunk, the users are split at every break of all the windows with readings
+    budgeted = run(raw, tmp_path / 'budgeted', window_sizes, memory_budget_mb=1e-6)
+
+    assert len(full[0]) == 8
+    for full_features, budgeted_features in zip(full, budgeted):
+        pd.testing.assert_frame_equal(budgeted_features, full_features)